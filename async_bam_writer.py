@@ -0,0 +1,115 @@
+from .bam_writer import BamWriter
+import asyncio
+
+
+class StreamTarget(object):
+    """ Adapts an asyncio.StreamWriter to the file-like interface expected
+    by BamWriter.  Flow control is left to the AsyncBamWriter, which awaits
+    drain() between batches. """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, data):
+        self.stream.write(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.stream.close()
+
+
+class AsyncBamWriter(BamWriter):
+    """ A BamWriter that sends its output over an asyncio stream, such as a
+    connection accepted by asyncio.start_server.
+
+    The coroutines ending in _async encode objects in batches of arena_size
+    bytes.  After each batch, they wait for the stream to drain and give
+    other tasks on the event loop a chance to run, so that a large scene
+    being pushed to one client does not hold up the others.  The inherited
+    synchronous methods still work as usual, but write everything in one
+    go without waiting for the stream. """
+
+    def __init__(self, arena_size=1 << 16, **kwargs):
+        super().__init__(arena_size=arena_size, **kwargs)
+
+    async def open_connection(self, host, port):
+        """ Connects to the given address and writes the header. """
+
+        reader, stream = await asyncio.open_connection(host, port)
+        await self.open_stream(stream)
+
+    async def open_stream(self, stream):
+        """ Starts writing to the given asyncio.StreamWriter, beginning with
+        the header. """
+
+        self.open_target(StreamTarget(stream))
+        await stream.drain()
+
+    async def close_async(self):
+        """ Closes the target, waiting for an asyncio stream to be closed. """
+
+        self.send_freed_ids()
+        self.target.close()
+        stream = getattr(self.target, 'stream', None)
+        if stream is not None:
+            await stream.wait_closed()
+
+    async def write_object_async(self, object):
+        await self.write_objects_async((object,))
+
+    async def write_objects_async(self, objects):
+        """ Writes the given objects, as BamWriter.write_objects does, but
+        yields to the event loop after every batch.  The target does not
+        need to be an asyncio stream; if it isn't, there is just nothing to
+        drain. """
+
+        stream = getattr(self.target, 'stream', None)
+        max_bytes = self.arena_size or 1 << 16
+
+        self.begin_objects(objects)
+        while not self.step(max_bytes):
+            if stream is not None:
+                await stream.drain()
+
+            # drain() only suspends if the transport's buffer is full, but
+            # other clients should get a turn either way.
+            await asyncio.sleep(0)
+
+        if stream is not None:
+            await stream.drain()
+
+    async def write_changes_async(self):
+        """ Like write_changes, but writes the modified objects as
+        write_objects_async does.  Returns the number of modified objects. """
+
+        changed = self.get_changed_objects()
+        await self.write_objects_async(changed)
+        return len(changed)
+
+    async def write_stream_async(self, roots):
+        """ Like write_stream, but writes each root as write_objects_async
+        does.  roots may also be an asynchronous iterable. """
+
+        count = 0
+        if hasattr(roots, '__aiter__'):
+            async for root in roots:
+                await self.write_objects_async((root,))
+                self.release_objects()
+                count += 1
+                del root
+        else:
+            for root in roots:
+                await self.write_objects_async((root,))
+                self.release_objects()
+                count += 1
+                del root
+
+        self.send_freed_ids()
+        stream = getattr(self.target, 'stream', None)
+        if stream is not None:
+            await stream.drain()
+
+        return count
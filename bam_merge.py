@@ -0,0 +1,560 @@
+""" Combines bam streams written by separate BamWriters into one stream, in
+which the roots of all streams are the children of a new ModelRoot.
+
+The objects are not decoded: their datagrams are copied as they are, except
+for the object IDs, PTA IDs and type indices in them, which are renumbered
+for the combined stream.  Since nothing in the body of an object says where
+its IDs are, this requires the relocations recorded by a BamWriter created
+with record_relocations=True, which may be saved alongside the stream:
+
+    writer = BamWriter(record_relocations=True)
+    writer.open_file('tile.bam')
+    writer.write_object(root)
+    writer.close()
+    writer.relocations.tofile(open('tile.bam.reloc', 'wb'))
+
+The tiles may then be combined with merge_streams, or from the command line:
+
+    python -m package.bam_merge level.bam tile1.bam tile2.bam ...
+
+All streams must have the same header, that is, the same file version and
+stdfloat mode, which must be at least 6.21.  The root of each stream, the
+first object written to it, must be a PandaNode.  Every block of every
+stream ends up in the single block of the combined stream. """
+
+__all__ = ['merge_streams']
+
+from .datagram import Datagram
+from .encoded_body import EncodedBody
+from .panda_types import ModelRoot
+from .bam_writer import BAM_MAGIC, BOC_push, BOC_pop, BOC_adjunct, BOC_file_data
+from .bam_writer import RELOC_PTA_ID, write_buffers
+from array import array
+from struct import Struct
+import mmap
+import sys
+
+_unpack_uint16 = Struct('<H').unpack_from
+_unpack_uint32 = Struct('<I').unpack_from
+_pack_uint16 = Struct('<H').pack
+_pack_uint32 = Struct('<I').pack
+
+# Datagrams are collected until there are at least this many bytes, and
+# slices of the inputs of at least this size are not copied.
+_FLUSH_SIZE = 1 << 20
+_ZERO_COPY_THRESHOLD = 1 << 16
+
+
+def merge_streams(inputs, target, name='', magic=True, relocations=None):
+    """ Writes a stream to the given file-like object in which a new
+    ModelRoot with the given name has the roots of the given streams as its
+    children.  inputs is a sequence of (data, relocations) pairs, where data
+    is a bytes-like object holding a stream written by a BamWriter, with or
+    without the magic number, and relocations are the BamWriter's recorded
+    relocations for it.
+
+    The combined stream is preceded by the magic number if magic is true.
+    If relocations is given, the relocations of the combined stream are
+    appended to it, so that it may be merged again later.  Returns the
+    number of objects in the combined stream. """
+
+    merger = _Merger(target, relocations)
+    return merger.merge([_InputStream(data, relocs) for data, relocs in inputs], name, magic)
+
+
+class _InputStream(object):
+    """ One of the streams being merged, along with the state needed to read
+    the IDs and type handles in it. """
+
+    def __init__(self, data, relocations):
+        view = memoryview(data).cast('B')
+        if view[:len(BAM_MAGIC)] == BAM_MAGIC:
+            view = view[len(BAM_MAGIC):]
+
+        self.data = view
+        self.relocations = relocations
+        self.next_reloc = 0
+        self.long_object_id = False
+        self.long_pta_id = False
+
+        # Maps the type indices declared in this stream to type names.
+        self.types = {}
+
+        # Maps the object and PTA IDs of this stream to those of the merged
+        # stream.
+        self.object_ids = {}
+        self.pta_ids = {}
+
+        # Set by the merger: the ID of the root, and the position of its
+        # parent count until the ModelRoot has been added to its parents.
+        self.root_id = None
+        self.parents_pos = None
+
+        length, = _unpack_uint32(view, 0)
+        self.header = view[4:4 + length].tobytes()
+        self.pos = 4 + length
+
+        if len(self.header) < 5:
+            raise ValueError("bam stream has no valid header")
+        self.file_version = _unpack_uint16(self.header, 0) + _unpack_uint16(self.header, 2)
+        if self.file_version < (6, 21):
+            raise ValueError("cannot merge bam streams older than version 6.21")
+
+    def read_object_id(self, pos):
+        """ Returns the object ID at the given position, and the position
+        following it. """
+
+        if self.long_object_id:
+            return _unpack_uint32(self.data, pos)[0], pos + 4
+
+        object_id, = _unpack_uint16(self.data, pos)
+        if object_id == 0xffff:
+            self.long_object_id = True
+        return object_id, pos + 2
+
+    def read_pta_id(self, pos):
+        """ Returns the PTA ID at the given position, and the position
+        following it. """
+
+        if self.long_pta_id:
+            return _unpack_uint32(self.data, pos)[0], pos + 4
+
+        pta_id, = _unpack_uint16(self.data, pos)
+        if pta_id == 0xffff:
+            self.long_pta_id = True
+        return pta_id, pos + 2
+
+    def read_string(self, pos):
+        """ Returns the string at the given position, and the position
+        following it. """
+
+        length, = _unpack_uint16(self.data, pos)
+        pos += 2
+        return self.data[pos:pos + length].tobytes().decode('utf-8'), pos + length
+
+
+class _Merger(object):
+    """ Keeps the state of the merged stream: the IDs and type indices
+    assigned so far, in the same way as a BamWriter does. """
+
+    def __init__(self, target, relocations=None):
+        self.target = target
+        self.relocations = relocations
+
+        self.next_object_id = 1
+        self.long_object_id = False
+        self.next_pta_id = 1
+        self.long_pta_id = False
+        self.next_type_index = 1
+
+        # Maps type names to type indices, and to the names of their bases.
+        self.__types = {}
+        self.__bases = {}
+
+        # New objects written by the merger itself, that is, the ModelRoot
+        # and whatever it points to, mapped to object IDs.
+        self.__objects = {}
+        self.__queue = []
+
+        self.__arena = Datagram()
+        self.__arena.zero_copy_threshold = _ZERO_COPY_THRESHOLD
+        self.__stream_pos = 0
+
+    def merge(self, streams, name, magic):
+        """ Writes the merged stream, and returns the number of objects. """
+
+        if not streams:
+            raise ValueError("no bam streams to merge")
+
+        header = streams[0].header
+        for stream in streams:
+            if stream.header != header:
+                raise ValueError("cannot merge bam streams with different headers")
+
+        file_version = streams[0].file_version
+        stdfloat_double = file_version >= (6, 27) and bool(header[5])
+
+        if magic:
+            self.target.write(BAM_MAGIC)
+
+        dg = self.__arena
+        marker = dg.begin_datagram()
+        dg.append_data(header)
+        dg.end_datagram(marker)
+
+        # The input streams stand in for their roots as the children of the
+        # ModelRoot; see write_pointer.
+        root = ModelRoot(name)
+        root.children = streams
+        for stream in streams:
+            self.__find_root(stream)
+
+        self.__write_new_object(root, BOC_push, file_version, stdfloat_double)
+        while self.__queue:
+            object = self.__queue.pop(0)
+            self.__write_new_object(object, BOC_adjunct, file_version, stdfloat_double)
+
+        for stream in streams:
+            self.__copy_stream(stream)
+
+        marker = dg.begin_datagram()
+        dg.add_uint8(BOC_pop)
+        dg.end_datagram(marker)
+        self.__flush_arena()
+        self.target.flush()
+
+        return self.next_object_id - 1
+
+    def write_pointer(self, dg, object):
+        """ Called by the bodies of the objects written by the merger. """
+
+        if object is None:
+            self.__write_object_id(dg, 0)
+
+        elif isinstance(object, _InputStream):
+            self.__write_object_id(dg, self.__map_object_id(object, object.root_id))
+
+        else:
+            object_id = self.__objects.get(object)
+            if object_id is None:
+                object_id = self.__objects[object] = self.__new_object_id()
+                self.__queue.append(object)
+            self.__write_object_id(dg, object_id)
+
+    def write_pta(self, dg, array_data):
+        raise TypeError("objects written by the merger can't have PTAs")
+
+    def write_internal_name(self, dg, string):
+        raise TypeError("objects written by the merger can't have internal names")
+
+    def __find_root(self, stream):
+        """ Finds the object ID of the root of the stream, that is, of the
+        first object in it, and the position of its parent count, which gets
+        incremented to make the ModelRoot its parent.  The first datagram is
+        read with 16-bit IDs, which any fresh stream starts out with. """
+
+        data = stream.data
+        pos = stream.pos + 4
+        if pos >= len(data) or data[pos] != BOC_push:
+            raise ValueError("bam stream does not start with an object")
+
+        types = {}
+        type_index, pos = self.__read_handle(stream, pos + 1, types)
+        if not self.__is_a(types[type_index], 'PandaNode'):
+            raise ValueError("root of bam stream is a %s, not a PandaNode" % (types[type_index]))
+
+        stream.root_id, = _unpack_uint16(data, pos)
+        name, pos = stream.read_string(pos + 2)
+
+        # The state, transform and effects pointers, the three masks, and
+        # the bounds type, if any.
+        pos += 3 * 2 + 3 * 4
+        if stream.file_version >= (6, 19):
+            pos += 1
+
+        num_tags, = _unpack_uint32(data, pos)
+        pos += 4
+        for i in range(num_tags * 2):
+            string, pos = stream.read_string(pos)
+
+        stream.parents_pos = pos
+
+    def __read_handle(self, stream, pos, types):
+        """ Reads the type handle at the given position, registering any
+        types declared by it in the given dictionary and in the merger's
+        table of bases.  Returns the type index and the position following
+        the handle. """
+
+        type_index, = _unpack_uint16(stream.data, pos)
+        pos += 2
+        if type_index == 0 or type_index in types:
+            return type_index, pos
+
+        name, pos = stream.read_string(pos)
+        types[type_index] = name
+        num_bases = stream.data[pos]
+        pos += 1
+
+        bases = []
+        for i in range(num_bases):
+            base_index, pos = self.__read_handle(stream, pos, types)
+            bases.append(types[base_index])
+        self.__bases.setdefault(name, tuple(bases))
+        return type_index, pos
+
+    def __is_a(self, name, base):
+        if name == base:
+            return True
+        return any(self.__is_a(parent, base) for parent in self.__bases.get(name, ()))
+
+    def __copy_handle(self, stream, pos, dg):
+        """ Copies the type handle at the given position in the stream to the
+        datagram, converting it for the merged stream.  Returns the position
+        following the handle. """
+
+        types = stream.types
+        type_index, = _unpack_uint16(stream.data, pos)
+        if type_index == 0:
+            dg.add_uint16(0)
+            return pos + 2
+
+        if type_index in types:
+            dg.add_uint16(self.__types[types[type_index]])
+            return pos + 2
+
+        # A declaration; read it first, along with any bases declared by it,
+        # and then declare whatever the merged stream does not have yet.
+        type_index, pos = self.__read_handle(stream, pos, types)
+        self.__write_handle(dg, types[type_index])
+        return pos
+
+    def __write_handle(self, dg, name):
+        """ Writes the type handle for the given type name, declaring it and
+        its bases if it hasn't been declared before. """
+
+        index = self.__types.get(name)
+        if index is not None:
+            dg.add_uint16(index)
+            return
+
+        index = self.next_type_index
+        assert index <= 65535
+        self.next_type_index += 1
+        self.__types[name] = index
+
+        dg.add_uint16(index)
+        dg.add_string(name)
+        bases = self.__bases[name]
+        dg.add_uint8(len(bases))
+        for base in bases:
+            self.__write_handle(dg, base)
+
+    def __write_new_object(self, object, boc, file_version, stdfloat_double):
+        """ Writes the datagram for an object created by the merger. """
+
+        # Leave out the object class itself, as write_handle does.
+        for cls in type(object).__mro__[:-1]:
+            self.__bases.setdefault(cls.__name__, tuple(base.__name__ for base in cls.__bases__
+                                                        if base.__bases__))
+
+        object_id = self.__objects.get(object)
+        if object_id is None:
+            object_id = self.__objects[object] = self.__new_object_id()
+
+        dg = self.__arena
+        marker = dg.begin_datagram()
+        dg.add_uint8(boc)
+        self.__write_handle(dg, type(object).__name__)
+        self.__write_object_id(dg, object_id)
+        EncodedBody.encode(object, file_version, stdfloat_double).write(self, dg)
+        dg.end_datagram(marker)
+
+    def __copy_stream(self, stream):
+        """ Copies all object datagrams in the stream to the merged stream. """
+
+        data = stream.data
+        end = len(data)
+        pos = stream.pos
+        while pos < end:
+            length, = _unpack_uint32(data, pos)
+            pos += 4
+            self.__copy_datagram(stream, pos, pos + length)
+            pos += length
+
+            if self.__arena.get_length() >= _FLUSH_SIZE:
+                self.__flush_arena()
+
+        if stream.next_reloc < len(stream.relocations):
+            raise ValueError("bam stream has relocations past its end")
+
+    def __copy_datagram(self, stream, start, end):
+        """ Copies the datagram between the given positions in the stream,
+        replacing the IDs and type handles in it. """
+
+        data = stream.data
+        boc = data[start]
+        if boc == BOC_pop:
+            return
+        if boc == BOC_file_data:
+            raise ValueError("cannot merge bam streams with file data")
+
+        dg = self.__arena
+        marker = dg.begin_datagram()
+        pos = start + 1
+
+        # Push and adjunct datagrams hold objects, which begin with a type
+        # handle; the IDs are taken care of by the relocations.
+        if boc == BOC_push or boc == BOC_adjunct:
+            dg.add_uint8(BOC_adjunct)
+            pos = self.__copy_handle(stream, pos, dg)
+            relocations = stream.relocations
+            i = stream.next_reloc
+            if i >= len(relocations) or relocations[i] >> 1 != pos:
+                raise ValueError("bam stream has no relocation for the object "
+                                 "ID at %d; was it written with "
+                                 "record_relocations?" % (pos))
+        else:
+            dg.add_uint8(boc)
+
+        parents_pos = stream.parents_pos
+        if parents_pos is not None:
+            # Make the ModelRoot, which is always object 1, the first parent
+            # of the stream's root.
+            stream.parents_pos = None
+            self.__copy_range(stream, dg, pos, parents_pos)
+            dg.add_uint16(_unpack_uint16(data, parents_pos)[0] + 1)
+            self.__write_object_id(dg, 1)
+            pos = parents_pos + 2
+
+        self.__copy_range(stream, dg, pos, end)
+        dg.end_datagram(marker)
+
+    def __copy_range(self, stream, dg, pos, end):
+        """ Copies the data between the given positions in the stream,
+        replacing the IDs at the relocations in between.  This is where
+        nearly all time is spent, hence the inlining. """
+
+        data = stream.data
+        relocations = stream.relocations
+        count = len(relocations)
+        i = stream.next_reloc
+        object_ids = stream.object_ids
+        long_input_id = stream.long_object_id
+        long_output_id = self.long_object_id
+        out_relocations = self.relocations
+
+        # Appending to dg.data directly is valid until the arena is flushed.
+        out = dg.data
+
+        while i < count:
+            reloc = relocations[i]
+            reloc_pos = reloc >> 1
+            if reloc_pos >= end:
+                break
+            i += 1
+
+            if reloc_pos - pos >= _ZERO_COPY_THRESHOLD:
+                dg.append_data(data[pos:reloc_pos])
+            else:
+                out += data[pos:reloc_pos]
+
+            if reloc & 1 == RELOC_PTA_ID:
+                pta_id, pos = stream.read_pta_id(reloc_pos)
+                self.__write_pta_id(dg, self.__map_pta_id(stream, pta_id))
+                continue
+
+            if long_input_id:
+                object_id, = _unpack_uint32(data, reloc_pos)
+                pos = reloc_pos + 4
+            else:
+                object_id, = _unpack_uint16(data, reloc_pos)
+                pos = reloc_pos + 2
+                long_input_id = object_id == 0xffff
+
+            if object_id != 0:
+                new_id = object_ids.get(object_id)
+                if new_id is None:
+                    new_id = object_ids[object_id] = self.next_object_id
+                    self.next_object_id += 1
+                object_id = new_id
+
+            if out_relocations is not None:
+                out_relocations.append((self.__stream_pos + dg.get_length()) << 1)
+
+            if long_output_id:
+                out += _pack_uint32(object_id)
+            else:
+                out += _pack_uint16(object_id)
+                long_output_id = object_id == 0xffff
+
+        stream.next_reloc = i
+        stream.long_object_id = long_input_id
+        self.long_object_id = long_output_id
+
+        if end - pos >= _ZERO_COPY_THRESHOLD:
+            dg.append_data(data[pos:end])
+        elif end > pos:
+            out += data[pos:end]
+
+    def __new_object_id(self):
+        object_id = self.next_object_id
+        self.next_object_id += 1
+        return object_id
+
+    def __map_object_id(self, stream, object_id):
+        """ Returns the ID in the merged stream of the given object ID of the
+        given input stream.  IDs are assigned in the order in which they are
+        first written, as by a BamWriter, so that the merged stream switches
+        to 32-bit IDs at the right time. """
+
+        if object_id == 0:
+            return 0
+
+        new_id = stream.object_ids.get(object_id)
+        if new_id is None:
+            new_id = stream.object_ids[object_id] = self.__new_object_id()
+        return new_id
+
+    def __map_pta_id(self, stream, pta_id):
+        if pta_id == 0:
+            return 0
+
+        new_id = stream.pta_ids.get(pta_id)
+        if new_id is None:
+            new_id = stream.pta_ids[pta_id] = self.next_pta_id
+            self.next_pta_id += 1
+        return new_id
+
+    def __write_object_id(self, dg, object_id):
+        if self.relocations is not None:
+            self.relocations.append((self.__stream_pos + dg.get_length()) << 1)
+
+        if self.long_object_id:
+            dg.add_uint32(object_id)
+        else:
+            dg.add_uint16(object_id)
+            if object_id == 0xffff:
+                self.long_object_id = True
+
+    def __write_pta_id(self, dg, pta_id):
+        if self.relocations is not None:
+            self.relocations.append((self.__stream_pos + dg.get_length()) << 1 | RELOC_PTA_ID)
+
+        if self.long_pta_id:
+            dg.add_uint32(pta_id)
+        else:
+            dg.add_uint16(pta_id)
+            if pta_id == 0xffff:
+                self.long_pta_id = True
+
+    def __flush_arena(self):
+        arena = self.__arena
+        self.__stream_pos += arena.get_length()
+        write_buffers(self.target, arena.get_buffers())
+        arena.clear()
+
+
+def _load(fn):
+    """ Returns the contents of the given bam file, mapped into memory, and
+    the relocations saved next to it. """
+
+    with open(fn, 'rb') as file:
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    relocations = array('Q')
+    with open(fn + '.reloc', 'rb') as file:
+        relocations.frombytes(file.read())
+    return data, relocations
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print("usage: python -m package.bam_merge output.bam input.bam...", file=sys.stderr)
+        sys.exit(2)
+
+    relocations = array('Q')
+    with open(sys.argv[1], 'wb') as target:
+        merge_streams([_load(fn) for fn in sys.argv[2:]], target, relocations=relocations)
+
+    with open(sys.argv[1] + '.reloc', 'wb') as file:
+        relocations.tofile(file)
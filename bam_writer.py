@@ -1,47 +1,238 @@
-from .datagram import Datagram
+from .datagram import Datagram, CountingDatagram, FileRegion
+from .targets import ThreadedTarget, CompressedTarget, MappedFileTarget
+from .targets import BroadcastTarget, SocketTarget
 from .panda_types import TypedWritable, TypedWritableReferenceCount
+from .panda_types import GeomVertexArrayData, Texture
+from .panda_types import RenderState, TransformState, RenderEffects, BillboardEffect
+from .panda_types import TextureStage, TransparencyAttrib, ColorAttrib, CullFaceAttrib
+from .panda_types import AntialiasAttrib, ColorBlendAttrib, RenderModeAttrib, LightAttrib
+from .serializers import compile_serializer
+from .encoded_body import EncodedBody, register_constant, constants
 from collections import deque
 from array import array
+import copy
+import io
+import operator
 import sys
+import os
+import time
+import weakref
+import zlib
 
 BAM_VERSION = (6, 41)
 
+# Written at the start of a .bam file, before the header datagram.
+BAM_MAGIC = b'pbj\0\n\r'
+
 BOC_push = 0
 BOC_pop = 1
 BOC_adjunct = 2
 BOC_remove = 3
 BOC_file_data = 4
 
+# Kinds of entries in BamWriter.relocations, which are stored in the lowest
+# bit of each entry, below the position of the ID in the stream.
+RELOC_OBJECT_ID = 0
+RELOC_PTA_ID = 1
+
+# The maximum number of buffers that may be passed to a single writev call.
+if hasattr(os, 'writev'):
+    try:
+        IOV_MAX = os.sysconf('SC_IOV_MAX')
+    except (ValueError, OSError):
+        IOV_MAX = 16
+
+# The singletons defined by the panda_types modules, which nearly every
+# scene refers to; see register_constant.
+for constant in (RenderState.empty, TransformState.identity,
+                 RenderEffects.empty, RenderEffects.billboard_axis,
+                 RenderEffects.billboard_point_eye,
+                 RenderEffects.billboard_point_world, BillboardEffect.axis,
+                 BillboardEffect.point_eye, BillboardEffect.point_world,
+                 TextureStage.default, TransparencyAttrib.none,
+                 TransparencyAttrib.alpha, TransparencyAttrib.multisample_mask,
+                 TransparencyAttrib.binary, ColorAttrib.off, ColorAttrib.vertex,
+                 CullFaceAttrib.cull_none, AntialiasAttrib.none,
+                 AntialiasAttrib.multisample, ColorBlendAttrib.none,
+                 ColorBlendAttrib.add, RenderModeAttrib.wireframe,
+                 LightAttrib.off):
+    register_constant(constant)
+del constant
+
+# Every class that a class derives from, other than object, in the order in
+# which write_handle visits them, and the type declarations written for them
+# keyed by the state of the writer; see write_handle.
+_type_hierarchies = {}
+_type_declarations = {}
+
+
+def _type_hierarchy(type_handle):
+    hierarchy = []
+    stack = [type_handle]
+    while stack:
+        handle = stack.pop()
+        if handle not in hierarchy:
+            hierarchy.append(handle)
+            stack.extend(reversed([base for base in handle.__bases__ if base is not object]))
+    return tuple(hierarchy)
+
+
+class _ReleasedObject(weakref.ref):
+    """ A weak reference to an object released by a BamWriter, which
+    remembers the ID it was written with and the key it is stored under. """
+
+    __slots__ = 'object_id', 'key'
+
+    def __new__(cls, object, callback, object_id):
+        return super().__new__(cls, object, callback)
+
+    def __init__(self, object, callback, object_id):
+        super().__init__(object, callback)
+        self.object_id = object_id
+        self.key = id(object)
+
+
 class InternalName(TypedWritableReferenceCount):
     __slots__ = 'name',
 
     def __init__(self, name):
+        super().__init__()
         self.name = name
 
     def write_datagram(self, manager, dg):
         dg.add_string(self.name)
 
 
+class WriteMetrics(object):
+    """ Statistics on how the stream was divided into writes to the target,
+    kept by a BamWriter whose metrics attribute is set to an instance.
+
+    The latency of a write is the time since the previous write, or since
+    the start of the write_objects call if more recent; it is how long the
+    first datagram in the write may have been held back by the writer. """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.writes = 0
+        self.bytes_written = 0
+        self.write_time = 0.0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    @property
+    def mean_latency(self):
+        return self.total_latency / self.writes if self.writes else 0.0
+
+    @property
+    def throughput(self):
+        """ Bytes per second passed to the target while writing. """
+        return self.bytes_written / self.write_time if self.write_time else 0.0
+
+    def record(self, size, write_time, latency):
+        self.writes += 1
+        self.bytes_written += size
+        self.write_time += write_time
+        self.total_latency += latency
+        if latency > self.max_latency:
+            self.max_latency = latency
+
+
 class BamWriter(object):
     """ Reimplementation of Panda's BamWriter in Python. """
 
-    def __init__(self):
+    # The types of objects held back until the end of a block by a writer
+    # created with progressive=True.
+    PROGRESSIVE_DEFERRED_TYPES = (GeomVertexArrayData, Texture)
+
+    def __init__(self, arena_size=0, zero_copy_threshold=None, progressive=False,
+                 compile_serializers=False, body_cache=None,
+                 record_relocations=False):
         self.target = None
 
+        # All datagrams are encoded into this one reusable buffer, which is
+        # written to the target once it holds at least arena_size bytes, and
+        # at the end of every write_objects call.  An arena_size of 0 writes
+        # out each datagram as soon as it is complete, unless the open method
+        # picks a batch size of its own, as most of them do.  The batch size
+        # for the current target is kept in __flush_size, so that arena_size
+        # itself stays as it was set.
+        self.arena_size = arena_size
+        self.__flush_size = arena_size
+        self.__arena = Datagram()
+
+        # If set, vertex arrays and PTAs of at least this many bytes are not
+        # copied into the arena; the arena references them instead and they
+        # are written out together with the surrounding datagrams using a
+        # single os.writev call, if the target has a file descriptor.
+        self.__arena.zero_copy_threshold = zero_copy_threshold
+
+        # Objects of these types are written after all other objects in the
+        # same block, so that a viewer receives the structure of the scene
+        # before any bulky vertex or texture data.  Within a block, the order
+        # does not matter to the reader, as long as the first object stays
+        # first.
+        self.deferred_types = self.PROGRESSIVE_DEFERRED_TYPES if progressive else ()
+        self.__deferred = None
+
+        # If set, objects are written by serializers compiled for the file
+        # version and stdfloat mode of this writer; see serializers.py.
+        self.compile_serializers = compile_serializers
+        self.__serializers = None
+
+        # Only set on the copy of the writer made by measure_objects.
+        self.__object_sizes = None
+
+        # Objects encoded in advance by prepare(), keyed by file version and
+        # stdfloat mode, mapped to (generation, body) pairs, and the
+        # InternalName objects created for strings passed to
+        # write_internal_name.  Both are shared with clones.
+        self.__prepared = {}
+        self.__bodies = None
+        self.__internal_names = {}
+
+        # May be set to a BodyCache, possibly shared with other writers, to
+        # reuse the encoded bodies of objects that have been written before.
+        self.body_cache = body_cache
+
+        # If record_relocations is set, the position of every object ID and
+        # PTA ID written to the stream is appended to this array, shifted
+        # left by one bit, with RELOC_OBJECT_ID or RELOC_PTA_ID in the lowest
+        # bit.  Positions are counted from the start of the header datagram,
+        # that is, after the magic number.  This is what bam_merge needs to
+        # combine streams without decoding the objects in them.
+        self.relocations = array('Q') if record_relocations else None
+        self.__stream_pos = 0
+
+        self.file_version = BAM_VERSION
+        self.file_endian = 1 if sys.byteorder == 'little' else 0
+        self.file_stdfloat_double = False
+
+        # May be set to a WriteMetrics object to collect statistics, which
+        # open_socket does by default.
+        self.metrics = None
+
+        self.__reset()
+
+    def __reset(self):
+        """ Puts the writer in the state of a new writer that has not written
+        anything yet, keeping its settings. """
+
         self.next_object_id = 1
         self.long_object_id = False
         self.next_pta_id = 1
         self.long_pta_id = False
         self.next_type_index = 1
 
-        self.file_version = BAM_VERSION
-        self.file_endian = 1 if sys.byteorder == 'little' else 0
-        self.file_stdfloat_double = False
-
         # Keep track of type IDs and object IDs already defined.
         self.types_written = set()
         self.objects_written = set()
 
+        # The generation of each object when it was last written, by ID, so
+        # that it is written again once it has been modified since.
+        self.__generations = {}
+
         # Map types to type IDs, objects to object IDs, arrays to PTA IDs.
         self.type_map = {}
         self.object_map = {}
@@ -50,28 +241,165 @@ class BamWriter(object):
         # Objects queued up for writing to the stream.
         self.object_queue = deque()
 
+        # Objects given up by release_objects(), which are only weakly
+        # referenced, keyed by id().  Each is a _ReleasedObject, which is
+        # appended to __freed once its object has been destroyed, so that its
+        # ID can be freed; see __write_freed_ids.
+        self.__released = {}
+        self.__freed = []
+
+        # True between begin_objects and the step that writes the pop.
+        self.__in_block = False
+        self.__block_objects = 0
+        self.__block_bytes = 0
+        self.__pending_since = 0.0
+
         # Special consideration for type 0.
         self.type_map[None] = 0
         self.types_written.add(0)
 
-    def open_file(self, fn):
-        self.target = open(fn, 'wb')
-        self.target.write(b'pbj\0\n\r')
-
-        header = Datagram()
-        self.write_header(header)
-        self.target.write(bytes(header))
+    def open_file(self, fn, async_io=False, compression_level=None,
+                  memory_map=False, size_hint=None):
+        """ Opens the given file for writing and writes the header.
+
+        If async_io is true, all writes to the file are done by a separate
+        I/O thread, so that encoding objects overlaps with writing them.
+        In that case, datagrams are handed over in batches of at least
+        arena_size bytes, or 64 KiB if arena_size is 0.
+
+        If a compression_level (0-9) is given, or the filename ends in .pz,
+        the file is written zlib-compressed, as Panda expects of .pz files.
+        Compression always happens on the I/O thread.  Compression
+        statistics may be obtained from self.target.target afterwards.
+
+        If memory_map is true, the file is written through a memory mapping
+        of size_hint bytes, which is grown as needed; see MappedFileTarget.
+        This cannot be combined with compression.  As with async_io, the
+        datagrams are copied into the mapping in batches of arena_size or
+        64 KiB.  Otherwise, they are written to the file in batches of
+        arena_size bytes, or 8 KiB if arena_size is 0. """
+
+        if memory_map:
+            if compression_level is not None or str(fn).endswith('.pz'):
+                raise ValueError("cannot memory-map a compressed file")
+            flush_size = self.arena_size or 1 << 16
+            target = MappedFileTarget(fn, size_hint)
+        else:
+            # The file is buffered anyway, so there is nothing to be gained
+            # from handing it each datagram separately.
+            flush_size = self.arena_size or io.DEFAULT_BUFFER_SIZE
+            target = open(fn, 'wb')
+
+        if compression_level is not None or str(fn).endswith('.pz'):
+            if compression_level is None:
+                compression_level = zlib.Z_DEFAULT_COMPRESSION
+            target = CompressedTarget(target, compression_level)
+            async_io = True
+
+        if async_io:
+            flush_size = self.arena_size or 1 << 16
+            target = ThreadedTarget(target)
+
+        self.__open_target(target, flush_size, magic=True)
+
+    def open_socket(self, host, port, async_io=False, flush_policy=None,
+                    nodelay=True, send_buffer_size=None):
+        """ Connects to the given address and writes the header.  See
+        open_file for the meaning of async_io.
+
+        The flush_policy determines how often the stream is sent: 'object'
+        sends each datagram as soon as it is encoded, for the lowest
+        latency; a number N sends whenever at least N bytes are pending;
+        and 'call' sends everything at once at the end of write_objects,
+        for the fewest sends, at the cost of holding all of the datagrams of
+        the call in memory, however large the objects are.  The default
+        sends every arena_size bytes, or every 8 KiB if arena_size is 0.
+        The policy only applies to this connection; arena_size is left as
+        it is.
+
+        Nagle's algorithm is disabled unless nodelay is false, since the
+        flush policy already determines how the stream is divided up.  If
+        send_buffer_size is given, it is used for SO_SNDBUF.
+
+        Statistics for tuning the flush policy are kept in self.metrics. """
 
-    def open_socket(self, host, port):
         import socket
-        conn = socket.create_connection((host, port))
-        self.target = conn.makefile('wb')
 
-        header = Datagram()
-        self.write_header(header)
-        self.target.write(bytes(header))
+        if flush_policy == 'object':
+            flush_size = 1
+        elif flush_policy == 'call':
+            flush_size = sys.maxsize
+        elif flush_policy is not None:
+            flush_size = int(flush_policy)
+        else:
+            flush_size = self.arena_size or io.DEFAULT_BUFFER_SIZE
+
+        conn = socket.create_connection((host, port))
+        if nodelay:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if send_buffer_size is not None:
+            conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, send_buffer_size)
+
+        if self.metrics is None:
+            self.metrics = WriteMetrics()
+
+        target = SocketTarget(conn)
+        if async_io:
+            target = ThreadedTarget(target)
+
+        self.__open_target(target, flush_size)
+
+    def open_broadcast(self, targets, max_buffered=1 << 24, policy='disconnect'):
+        """ Starts writing to all of the given file-like objects at once,
+        such as the connections of several viewers, and writes the header.
+        Objects are encoded only once; see BroadcastTarget for the meaning of
+        the other arguments.  Clients may be added to or looked up in
+        self.target afterwards.
+
+        As with async_io, datagrams are handed over in batches of arena_size
+        or 64 KiB. """
+
+        target = BroadcastTarget(targets, max_buffered, policy)
+        self.__open_target(target, self.arena_size or 1 << 16)
+
+    def open_shared_memory(self, name=None, capacity=1 << 22, timeout=None):
+        """ Creates a shared memory ring buffer of the given capacity for
+        another process on this machine to read from, using a
+        RingBufferReader, and writes the header to it.  Returns the name of
+        the shared memory.  See RingBufferTarget for the meaning of timeout.
+
+        As with async_io, datagrams are copied into the ring in batches of
+        arena_size or 64 KiB, rather than waking up the reader for each. """
+
+        from .ring_buffer import RingBufferTarget
+        target = RingBufferTarget(name, capacity, timeout)
+        self.__open_target(target, self.arena_size or 1 << 16)
+        return target.name
+
+    def open_target(self, target, magic=False):
+        """ Starts writing to the given file-like object, which only needs
+        to provide write(), flush() and close() methods.  Writes the header,
+        preceded by the bam magic number if magic is true, as is needed for
+        .bam files but not for streams sent over a network.  Datagrams are
+        written to it in batches of arena_size bytes. """
+
+        self.__open_target(target, self.arena_size, magic)
+
+    def __open_target(self, target, flush_size, magic=False):
+        """ Starts writing to the given target, in batches of flush_size
+        bytes, and writes the header. """
+
+        self.target = target
+        self.__flush_size = flush_size
+        if magic:
+            target.write(BAM_MAGIC)
+        self.__stream_pos = 0
+        self.__write_header_datagram()
 
     def close(self):
+        # Let the reader know about the objects destroyed since the last
+        # block, as there won't be another one.
+        self.send_freed_ids()
         self.target.close()
 
     def write_header(self, dg):
@@ -103,29 +431,300 @@ class BamWriter(object):
     def write_objects(self, objects):
         """ Like write_object, but writes more than one object. """
 
+        self.begin_objects(objects)
+        self.step()
+
+    def write_changes(self):
+        """ Sends every object that has been modified since this writer last
+        wrote it, along with any objects they now refer to that have not
+        been written yet.  Returns the number of modified objects.
+
+        Combined with enable_change_tracking(), which sets the modified
+        flags automatically, this keeps a viewer up to date without having
+        to keep track of what was changed.  Finding the modified objects
+        takes a pass over every object written so far. """
+
+        changed = self.get_changed_objects()
+        self.write_objects(changed)
+        return len(changed)
+
+    def get_changed_objects(self):
+        """ Returns a list of the objects that have been modified since this
+        writer last wrote them, as sent by write_changes(). """
+
+        assert not self.__in_block
+
+        # Everything in object_map has been written by now.  It also maps
+        # the strings of internal names, which have no generation.
+        generations = self.__generations
+        changed = []
+        for object, object_id in self.object_map.items():
+            generation = getattr(object, 'generation', None)
+            if generation is not None and generation != generations[object_id]:
+                changed.append(object)
+
+        for ref in self.__released.values():
+            object = ref()
+            if object is not None and object.generation != generations[ref.object_id]:
+                changed.append(object)
+
+        return changed
+
+    def write_stream(self, roots):
+        """ Writes each object produced by the given iterable, such as a
+        generator, in a block of its own, calling release_objects() after
+        each one.  The writer thereby holds on to no more than one root and
+        the objects it refers to at a time, so that a world larger than
+        memory can be written, as long as the iterable creates the roots
+        as they are needed.  Returns the number of roots written. """
+
+        count = 0
+        for root in roots:
+            self.write_object(root)
+            self.release_objects()
+            count += 1
+
+            # Don't keep this root alive while the next one is created.
+            del root
+
+        self.send_freed_ids()
+        return count
+
+    def release_objects(self):
+        """ Drops the references this writer holds to the objects written
+        so far, keeping only weak references to them.  Pointers to objects
+        that are still alive are written as usual, using the IDs they were
+        written with.  Once an object has been destroyed, the writer forgets
+        about it, and frees its ID by sending a BOC_remove datagram before
+        the next block, or at the end of write_stream or on close() if there
+        is none, so that the reader may destroy its copy as well.
+
+        Also forgets the PTAs written so far, which are sent again if they
+        are written once more. """
+
+        assert not self.__in_block
+
+        released = self.__released
+        callback = self.__freed.append
+        strings = {}
+        for object, object_id in self.object_map.items():
+            if isinstance(object, str):
+                strings[object] = object_id
+            else:
+                released[id(object)] = _ReleasedObject(object, callback, object_id)
+
+        self.object_map = strings
+        self.pta_map = {}
+
+    def send_freed_ids(self):
+        """ Sends the IDs of the released objects that have been destroyed
+        since the last block right away, rather than before the next block.
+        Called by write_stream and close().  Does nothing in the middle of a
+        block, as begun by begin_objects. """
+
+        if not self.__in_block and self.__write_freed_ids():
+            self.__flush_arena()
+            self.target.flush()
+
+    def begin_objects(self, objects):
+        """ Starts writing the given objects, like write_objects, but does
+        not actually write anything yet; the objects are written by
+        subsequent calls to step(). """
+
         if len(objects) == 0:
             return
 
+        assert not self.__in_block
         assert len(self.object_queue) == 0
+        self.__arena.set_stdfloat_double(self.file_stdfloat_double)
+        self.__write_freed_ids()
         self.next_boc = BOC_push
+        self.__in_block = True
+        self.__block_objects = 0
+        self.__block_bytes = 0
+        self.__pending_since = time.perf_counter()
+        self.__deferred = deque() if self.deferred_types else None
+        self.__serializers = {} if self.compile_serializers else None
+        self.__bodies = self.__prepared.get((self.file_version, self.file_stdfloat_double))
 
         for object in objects:
             object_id = self.__enqueue_object(object)
             assert object_id != 0
-        self.__flush_queue()
+
+    def step(self, max_bytes=None, max_time=None):
+        """ Continues writing the objects passed to begin_objects, until
+        either all of them have been written, at least max_bytes have been
+        encoded by this call, or max_time seconds have passed.  Objects are
+        never split up, so either budget may be exceeded by the time or size
+        of a single object.  Returns True once everything has been written
+        and flushed to the target, False if step() needs to be called again.
+        """
+
+        if not self.__in_block:
+            return True
+
+        deadline = None
+        if max_time is not None:
+            deadline = time.perf_counter() + max_time
+
+        if not self.__flush_queue(max_bytes, deadline):
+            return False
 
         # Finally, write the closing pop.
-        dg = Datagram()
-        dg.add_uint8(BOC_pop)
-        self.target.write(bytes(dg))
+        arena = self.__arena
+        marker = arena.begin_datagram()
+        arena.add_uint8(BOC_pop)
+        arena.end_datagram(marker)
+        self.__in_block = False
+
+        self.__flush_arena()
         self.target.flush()
+        return True
+
+    def iter_write_objects(self, objects, max_bytes=None, max_time=None):
+        """ Returns a generator that writes the given objects, like
+        write_objects, in steps limited by max_bytes and max_time (see
+        step()).  After every step that leaves work to be done, it yields the
+        current progress, as returned by get_progress(). """
+
+        self.begin_objects(objects)
+        while not self.step(max_bytes, max_time):
+            yield self.get_progress()
+
+    def get_progress(self):
+        """ Returns an (objects_written, bytes_written, objects_pending)
+        tuple for the objects passed to the last begin_objects call.  The
+        number of pending objects grows as more objects are discovered
+        through the pointers of the objects being written. """
+
+        pending = len(self.object_queue)
+        if self.__deferred:
+            pending += len(self.__deferred)
+        return self.__block_objects, self.__block_bytes, pending
+
+    def measure_objects(self, objects):
+        """ Determines exactly how many bytes write_objects would write for
+        the given objects, without writing anything to the target or
+        changing the state of this writer.
+
+        This is not much cheaper than writing: the objects are serialized as
+        usual, into a CountingDatagram that only adds up the sizes.  Only
+        large buffers are cheaper to measure, since they are not copied.
+
+        Returns a (total_size, object_sizes) tuple, where object_sizes maps
+        each object to the combined size of the datagrams written for it.
+        The size of the file header is not included; that is given by
+        len(BAM_MAGIC) + measure_header(). """
+
+        sizer = copy.copy(self)
+        sizer.target = None
+        sizer.types_written = set(self.types_written)
+        sizer.objects_written = set(self.objects_written)
+        sizer.type_map = dict(self.type_map)
+        sizer.object_map = dict(self.object_map)
+        sizer.pta_map = dict(self.pta_map)
+        sizer.object_queue = deque()
+        sizer.__arena = CountingDatagram(self.file_stdfloat_double)
+        sizer.__object_sizes = {}
+        sizer.__generations = dict(self.__generations)
+
+        # The sizer doesn't reset the modified flags, which the body cache
+        # relies on to tell generations apart; see TypedWritable.modified.
+        sizer.body_cache = None
+        sizer.__deferred = deque() if self.deferred_types else None
+        sizer.__block_objects = 0
+        sizer.__serializers = None
+        sizer.__bodies = self.__prepared.get((self.file_version, self.file_stdfloat_double))
+        sizer.relocations = None
+        sizer.__released = dict(self.__released)
+        sizer.__freed = list(self.__freed)
+
+        if len(objects) == 0:
+            return 0, {}
+
+        sizer.__write_freed_ids()
+        sizer.next_boc = BOC_push
+        for object in objects:
+            sizer.__enqueue_object(object)
+        sizer.__flush_queue()
+
+        # The closing pop.
+        return sizer.__arena.get_length() + 5, sizer.__object_sizes
+
+    def measure_header(self):
+        """ Returns the size of the header datagram, including its length
+        prefix. """
+
+        dg = CountingDatagram()
+        self.write_header(dg)
+        return dg.get_length() + 4
+
+    def prepare(self, objects=(), internal_names=()):
+        """ Sets this writer up as a template for clone(), by encoding the
+        given objects in advance for the current file version and stdfloat
+        mode, and creating InternalName objects for the given strings.  The
+        objects are typically ones shared by all of the scenes written by
+        the clones, such as RenderState.empty.  The objects they refer to
+        are not encoded unless they are passed too.
+
+        Whenever one of these objects is written, by this writer or a
+        clone, the encoded body is written in place of calling its
+        write_datagram method.  The output is the same either way.  Once an
+        object has been modified, that is, its generation has changed, its
+        write_datagram method is called again, until it is passed to
+        prepare() once more. """
+
+        key = (self.file_version, self.file_stdfloat_double)
+        bodies = self.__prepared.setdefault(key, {})
+
+        objects = list(objects)
+        for string in internal_names:
+            name = self.__internal_names.get(string)
+            if name is None:
+                name = InternalName(string)
+                self.__internal_names[string] = name
+            objects.append(name)
+
+        for object in objects:
+            assert isinstance(object, TypedWritable)
+            body = EncodedBody.encode(object, *key)
+            if body is not None:
+                bodies[object] = (object.generation, body)
+            else:
+                bodies.pop(object, None)
+
+    def clone(self):
+        """ Returns a new writer with the same settings as this one, which
+        writes exactly what a newly created writer with those settings
+        would.  It shares the objects encoded by prepare() and the interned
+        internal names of this writer, so that a writer set up once as a
+        template can cheaply be cloned for every scene or request. """
+
+        assert not self.__in_block
+
+        writer = self.__class__.__new__(self.__class__)
+        writer.__dict__.update(self.__dict__)
+        writer.target = None
+        writer.__flush_size = self.arena_size
+        writer.__arena = Datagram()
+        writer.__arena.zero_copy_threshold = self.__arena.zero_copy_threshold
+        if self.relocations is not None:
+            writer.relocations = array('Q')
+        if self.metrics is not None:
+            writer.metrics = WriteMetrics()
+        writer.__reset()
+        return writer
 
     def has_object(self, object):
         """ Returns true if the object has previously been
         written (or at least requested to be written) to the
         bam file, or false if we've never heard of it before.
         """
-        return object in self.object_map
+        if object in self.object_map:
+            return True
+
+        ref = self.__released.get(id(object))
+        return ref is not None and ref() is object
 
     def write_pointer(self, packet, object):
         """ The interface for writing a pointer to another object
@@ -146,6 +745,9 @@ class BamWriter(object):
 
         else:
             object_id = self.object_map.get(object)
+            if not object_id and self.__released:
+                object_id = self.__recall(object)
+
             if not object_id:
                 # We have not written this pointer out yet.  This means we must
                 # queue the object definition up for later.
@@ -164,7 +766,7 @@ class BamWriter(object):
             packet.add_uint32(0)
 
         else:
-            assert isinstance(array_data, array)
+            assert isinstance(array_data, (array, FileRegion))
 
             pta_id = self.pta_map.get(id(array_data))
             if not pta_id:
@@ -174,8 +776,11 @@ class BamWriter(object):
                 self.pta_map[id(array_data)] = pta_id
 
                 # We trust that the caller used the correct format code.
-                packet.add_uint32(len(array_data))
-                packet.data += array_data
+                if isinstance(array_data, FileRegion):
+                    packet.add_uint32(array_data.length // array_data.itemsize)
+                else:
+                    packet.add_uint32(len(array_data))
+                packet.append_data(array_data)
 
             self.__write_pta_id(packet, pta_id)
 
@@ -184,6 +789,54 @@ class BamWriter(object):
             packet.add_uint16(0)
             return
 
+        type_map = self.type_map
+        types_written = self.types_written
+
+        index = type_map.get(type_handle)
+        if index and index in types_written:
+            packet.add_uint16(index)
+            return
+
+        # Declaring a type (and any undeclared bases) produces the same bytes
+        # and the same new type indices for every writer that is in the same
+        # state with respect to the types in the hierarchy, so the result is
+        # shared between writers.
+        hierarchy = _type_hierarchies.get(type_handle)
+        if hierarchy is None:
+            hierarchy = _type_hierarchy(type_handle)
+            _type_hierarchies[type_handle] = hierarchy
+
+        key = [type_handle, self.next_type_index]
+        for handle in hierarchy:
+            index = type_map.get(handle)
+            key.append(index)
+            key.append(index in types_written)
+        key = tuple(key)
+
+        declaration = _type_declarations.get(key)
+        if declaration is None:
+            before = [type_map.get(handle) for handle in hierarchy]
+            dg = Datagram()
+            self.__declare_handle(dg, type_handle)
+            assigned = tuple((handle, type_map[handle])
+                             for handle, index in zip(hierarchy, before)
+                             if type_map.get(handle) != index)
+
+            if len(_type_declarations) >= 4096:
+                _type_declarations.clear()
+            _type_declarations[key] = (bytes(dg.data), assigned, self.next_type_index)
+            packet.append_data(dg.data)
+            return
+
+        blob, assigned, self.next_type_index = declaration
+        for handle, index in assigned:
+            type_map[handle] = index
+            types_written.add(index)
+        packet.append_data(blob)
+
+    def __declare_handle(self, packet, type_handle):
+        """ Writes the type handle, declaring it if necessary. """
+
         index = self.type_map.get(type_handle)
         if not index:
             # Assign a unique type index to this type.
@@ -205,7 +858,7 @@ class BamWriter(object):
 
             packet.add_uint8(len(bases))
             for base in bases:
-                self.write_handle(packet, base)
+                self.__declare_handle(packet, base)
 
     def write_internal_name(self, packet, string):
         """ Convenience method for writing strings where InternalName objects
@@ -218,7 +871,12 @@ class BamWriter(object):
         if not object_id:
             # We have not written this string out yet.  This means we must
             # queue the object definition up for later.
-            object_id = self.__enqueue_object(InternalName(string))
+            name = self.__internal_names.get(string)
+            if name is None:
+                name = InternalName(string)
+                self.__internal_names[string] = name
+
+            object_id = self.__enqueue_object(name)
             self.object_map[string] = object_id
 
         self.__write_object_id(packet, object_id)
@@ -226,6 +884,9 @@ class BamWriter(object):
     def __write_object_id(self, dg, object_id):
         """ Writes the indicated object ID to the datagram. """
 
+        if self.relocations is not None:
+            self.relocations.append((self.__stream_pos + dg.get_length()) << 1 | RELOC_OBJECT_ID)
+
         if self.long_object_id:
             dg.add_uint32(object_id)
 
@@ -239,6 +900,9 @@ class BamWriter(object):
     def __write_pta_id(self, dg, pta_id):
         """ Writes the indicated PTA ID to the datagram. """
 
+        if self.relocations is not None:
+            self.relocations.append((self.__stream_pos + dg.get_length()) << 1 | RELOC_PTA_ID)
+
         if self.long_pta_id:
             dg.add_uint32(pta_id)
 
@@ -258,6 +922,8 @@ class BamWriter(object):
         assert isinstance(object, TypedWritable)
 
         object_id = self.object_map.get(object)
+        if not object_id and self.__released:
+            object_id = self.__recall(object)
 
         if not object_id:
             # It has not been written before; assign a new object ID.
@@ -269,35 +935,277 @@ class BamWriter(object):
         self.object_queue.append(object)
         return object_id
 
-    def __flush_queue(self):
+    def __recall(self, object):
+        """ Returns the ID of the given object if it was released by
+        release_objects(), taking it back into object_map, or 0 if not. """
+
+        released = self.__released
+        ref = released.get(id(object))
+        if ref is None or ref() is not object:
+            return 0
+
+        # Dropping the weak reference also drops its callback.
+        del released[ref.key]
+        self.object_map[object] = ref.object_id
+        return ref.object_id
+
+    def __write_freed_ids(self):
+        """ Forgets the released objects that have been destroyed since the
+        last block, and writes a BOC_remove datagram listing their IDs, which
+        are never used again, in order.  Older versions have no way to say
+        this, so the reader keeps its copies there.  Returns True if the
+        datagram was written. """
+
+        freed = self.__freed
+        if not freed:
+            return False
+
+        # The list may grow while this runs, as its items are appended by
+        # weakref callbacks.
+        count = len(freed)
+        refs = freed[:count]
+        del freed[:count]
+        refs.sort(key=operator.attrgetter('object_id'))
+
+        released = self.__released
+        generations = self.__generations
+        objects_written = self.objects_written
+        for ref in refs:
+            if released.get(ref.key) is ref:
+                del released[ref.key]
+            generations.pop(ref.object_id, None)
+            objects_written.discard(ref.object_id)
+
+        if self.file_version >= (6, 21):
+            dg = self.__arena
+            marker = dg.begin_datagram()
+            dg.add_uint8(BOC_remove)
+            for ref in refs:
+                self.__write_object_id(dg, ref.object_id)
+            dg.end_datagram(marker)
+            return True
+
+        return False
+
+    def __flush_queue(self, max_bytes=None, deadline=None):
         """ Writes all of the objects on the _object_queue to the
-        bam stream, until the queue is empty. """
-
-        while self.object_queue:
-            object = self.object_queue.popleft()
-
-            dg = Datagram(stdfloat_double=self.file_stdfloat_double)
-
-            if self.file_version >= (6, 21):
+        bam stream, until the queue is empty.  Returns False if it stopped
+        early because at least max_bytes were encoded or the deadline (in
+        terms of time.perf_counter) has passed. """
+
+        dg = self.__arena
+        budget = max_bytes
+        flush_size = self.__flush_size
+        object_sizes = self.__object_sizes
+        generations = self.__generations
+        objects_written = self.objects_written
+        object_map = self.object_map
+        serializers = self.__serializers
+        write_handle = self.write_handle
+        write_object_id = self.__write_object_id
+        write_boc = self.file_version >= (6, 21)
+
+        # Only look for an encoded body elsewhere when there is somewhere to
+        # find one, which there isn't when writing with the default settings;
+        # otherwise, only registered constants have one.
+        body_key = (self.file_version, self.file_stdfloat_double)
+        find_body = None
+        if self.__bodies or self.body_cache is not None:
+            find_body = self.__find_body
+
+        queue = self.object_queue
+        deferred = self.__deferred
+        while queue or deferred:
+            if not queue:
+                # Everything else has been written; now for the deferred
+                # objects, and whatever they refer to, in their usual order.
+                queue = self.object_queue = deferred
+                deferred = self.__deferred = None
+
+            object = queue.popleft()
+
+            if deferred is not None and self.__block_objects > 0 and \
+               isinstance(object, self.deferred_types):
+                deferred.append(object)
+                continue
+
+            # Measured from here, as the arena may also hold the external
+            # segments of earlier datagrams that the marker doesn't count.
+            before = dg.get_length()
+            marker = dg.begin_datagram()
+
+            if write_boc:
                 dg.add_uint8(self.next_boc)
                 self.next_boc = BOC_adjunct
 
-            object_id = self.object_map[object]
-
-            if object_id not in self.objects_written or object.modified:
-                self.write_handle(dg, type(object))
-                self.__write_object_id(dg, object_id)
-
-                object.write_datagram(self, dg)
-                self.objects_written.add(object_id)
-                object.modified = False
+            object_id = object_map[object]
+
+            if object_id not in objects_written or \
+               object.generation != generations[object_id]:
+                write_handle(dg, type(object))
+                write_object_id(dg, object_id)
+
+                body = None
+                if find_body is not None:
+                    body = find_body(object, body_key)
+                elif object in constants:
+                    body = constants[object].get_body(object, body_key)
+
+                if body is not None:
+                    body.write(self, dg)
+                elif serializers is None:
+                    object.write_datagram(self, dg)
+                else:
+                    serializer = serializers.get(type(object))
+                    if serializer is None:
+                        serializer = compile_serializer(type(object), self.file_version,
+                                                        self.file_stdfloat_double)
+                        serializers[type(object)] = serializer
+                    serializer(object, self, dg)
+
+                objects_written.add(object_id)
+                generations[object_id] = getattr(object, 'generation', 0)
+
+                # Leave the object itself untouched when measuring.  Clearing
+                # the flag doesn't need to go through the property, which
+                # only does anything more when it is set.
+                if object_sizes is None:
+                    object._modified = False
 
             else:
                 # If we've already written this object, write it out with
                 # type index 0, which is an indicator that the object was
                 # previously written and will not be respecified.
-                self.write_handle(dg, None)
-                self.__write_object_id(dg, object_id)
+                write_handle(dg, None)
+                write_object_id(dg, object_id)
+
+            dg.end_datagram(marker)
+            length = dg.get_length()
+            size = length - before
+            self.__block_objects += 1
+            self.__block_bytes += size
+
+            if object_sizes is not None:
+                object_sizes[object] = object_sizes.get(object, 0) + size
+
+            elif length >= flush_size:
+                self.__flush_arena()
+
+            if budget is not None:
+                budget -= size
+                if budget <= 0:
+                    return not queue and not deferred
+
+            if deadline is not None and time.perf_counter() >= deadline:
+                return not queue and not deferred
+
+        return True
+
+    def __find_body(self, object, key):
+        """ Returns the encoded body of the given object from the first body
+        source that has one, or None if the object needs to be encoded. """
+
+        bodies = self.__bodies
+        if bodies:
+            prepared = bodies.get(object)
+            if prepared is not None and prepared[0] == object.generation:
+                return prepared[1]
+
+        constant = constants.get(object)
+        if constant is not None:
+            return constant.get_body(object, key)
+
+        if self.body_cache is not None:
+            return self.body_cache.get_body(object, key)
+
+        return None
+
+    def __write_header_datagram(self):
+        """ Writes the header datagram to the target right away. """
+
+        self.__pending_since = time.perf_counter()
+        arena = self.__arena
+        marker = arena.begin_datagram()
+        self.write_header(arena)
+        arena.end_datagram(marker)
+        self.__flush_arena()
+
+    def __flush_arena(self):
+        """ Writes out everything encoded into the arena so far, so that it
+        may be reused for the next datagrams. """
+
+        arena = self.__arena
+        metrics = self.metrics
+        size = arena.get_length()
+        self.__stream_pos += size
+        if metrics is not None:
+            start = time.perf_counter()
+
+        if arena.segments:
+            write_buffers(self.target, arena.get_buffers())
+            arena.clear()
+
+        elif arena.get_length() > 0:
+            self.target.write(arena.data)
+            arena.clear()
+
+        else:
+            return
+
+        if metrics is not None:
+            end = time.perf_counter()
+            metrics.record(size, end - start, end - self.__pending_since)
+            self.__pending_since = end
+
+
+def write_buffers(target, buffers):
+    """ Writes the given sequence of buffers to the target file object.  If
+    the target is backed by a file descriptor (a regular file, pipe or
+    socket), this is done using os.writev, so that the buffers do not need
+    to be joined or copied into the target's own buffer first.  Any
+    FileRegions among the buffers are then copied by the kernel. """
+
+    try:
+        fd = target.fileno()
+    except (AttributeError, OSError, ValueError):
+        fd = None
+
+    if fd is None or not hasattr(os, 'writev'):
+        for buffer in buffers:
+            if isinstance(buffer, FileRegion):
+                buffer.write_to(target)
+            else:
+                target.write(buffer)
+        return
+
+    # Anything still sitting in the file object's buffer needs to go first.
+    target.flush()
+
+    pending = []
+    for buffer in buffers:
+        if isinstance(buffer, FileRegion):
+            writev_all(fd, pending)
+            pending = []
+            buffer.copy_to_fd(fd)
+        else:
+            pending.append(buffer)
+
+    writev_all(fd, pending)
+
+
+def writev_all(fd, buffers):
+    """ Writes all of the given buffers to the file descriptor, using as few
+    os.writev calls as possible. """
+
+    buffers = deque(memoryview(buffer).cast('B') for buffer in buffers)
+    while buffers:
+        if len(buffers) > IOV_MAX:
+            written = os.writev(fd, [buffers[i] for i in range(IOV_MAX)])
+        else:
+            written = os.writev(fd, buffers)
 
-            # Write out the datagram to the stream.
-            self.target.write(bytes(dg))
+        # Drop whatever was written, which may end in the middle of a buffer.
+        while buffers and written >= buffers[0].nbytes:
+            written -= buffers.popleft().nbytes
+        if written > 0:
+            buffers[0] = buffers[0][written:]
@@ -0,0 +1,592 @@
+from .panda_types import *
+from .bam_writer import BamWriter, BAM_VERSION, BAM_MAGIC, BOC_push, BOC_remove
+from .bam_merge import merge_streams
+from .datagram import Datagram
+from .encoded_body import BodyCache, constants
+from .ring_buffer import RingBufferReader
+from .test import build_scene
+from array import array
+import gc
+import io
+import multiprocessing
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
+import weakref
+
+# The file versions to check, with the stdfloat modes to check them in;
+# versions before 6.27 can only use 32-bit floats.
+CONFIGS = [((6, 14), False), ((6, 21), False), ((6, 30), False),
+           ((6, 30), True), ((6, 41), False), ((6, 41), True),
+           ((6, 45), False)]
+
+
+def write(root, file_version, stdfloat_double, **kwargs):
+    """ Writes the root with a new BamWriter with the given settings, and
+    returns the bytes written, along with the recorded relocations if
+    record_relocations is given. """
+
+    writer = BamWriter(**kwargs)
+    writer.file_version = file_version
+    writer.file_stdfloat_double = stdfloat_double
+
+    target = io.BytesIO()
+    target.close = lambda: None
+    writer.open_target(target, magic=True)
+    writer.write_object(root)
+    writer.close()
+    return target.getvalue(), writer.relocations
+
+
+def check_serializers(file_version, stdfloat_double):
+    """ Checks that the compiled serializers write the same bytes as the
+    write_datagram methods of the objects. """
+
+    plain = write(build_scene(), file_version, stdfloat_double)[0]
+    compiled = write(build_scene(), file_version, stdfloat_double,
+                     compile_serializers=True)[0]
+    return compiled == plain
+
+
+def check_merge(file_version, stdfloat_double):
+    """ Checks that merging a single stream writes the same bytes and
+    relocations as writing its root directly as the child of a ModelRoot. """
+
+    tile = build_scene()
+    data, relocations = write(tile, file_version, stdfloat_double,
+                              record_relocations=True)
+
+    merged = io.BytesIO()
+    merged_relocations = array('Q')
+    merge_streams([(data, relocations)], merged, 'level',
+                  relocations=merged_relocations)
+
+    # The merger writes the constants that its ModelRoot points to anew,
+    # even if the stream refers to them too, whereas a direct write would
+    # only write them once; so the ModelRoot gets stand-ins for them.
+    root = ModelRoot('level')
+    root.state = RenderState()
+    root.transform = TransformState()
+    root.effects = RenderEffects()
+    root.children = [tile]
+    tile.parents.insert(0, root)
+    direct = write(root, file_version, stdfloat_double,
+                   record_relocations=True)
+
+    return (merged.getvalue(), merged_relocations) == direct
+
+
+def build_arrays(count, size):
+    """ Builds a scene with the given number of vertex arrays, each holding
+    the given number of bytes. """
+
+    root = PandaNode("arrays")
+    for i in range(count):
+        array_format = GeomVertexArrayFormat()
+        array_format.add_column("vertex", 3, GeomEnums.NT_float32,
+                                GeomEnums.C_point, start=0, column_alignment=4)
+        array_data = GeomVertexArrayData(array_format, GeomEnums.UH_static)
+        array_data.buffer = bytearray([i]) * size
+
+        data = GeomVertexData("arrays", GeomVertexFormat(array_format),
+                              GeomEnums.UH_static)
+        data.arrays.append(array_data)
+
+        node = GeomNode("array%d" % i)
+        node.add_geom(Geom(data))
+        root.add_child(node)
+
+    return root
+
+
+def check_budget():
+    """ Checks that writing in steps of max_bytes, with the arrays referenced
+    from the arena rather than copied, writes the same bytes as a plain
+    write, and that the progress reports the bytes actually written, so that
+    each step stops after about max_bytes. """
+
+    root = build_arrays(5, 100000)
+    plain = write(root, BAM_VERSION, False)[0]
+
+    writer = BamWriter(arena_size=1 << 22, zero_copy_threshold=64)
+    target = io.BytesIO()
+    writer.open_target(target, magic=True)
+    start = target.tell()
+
+    steps = 1
+    for objects, size, pending in writer.iter_write_objects([root], max_bytes=50000):
+        steps += 1
+
+    # The progress doesn't include the closing pop datagram.
+    objects, size, pending = writer.get_progress()
+    written = target.tell() - start
+    return target.getvalue() == plain and size + 5 == written and steps <= 6
+
+
+def check_cache_release():
+    """ Checks that bodies taken from a BodyCache give the same bytes as
+    encoding the objects, and that the cache doesn't keep the objects alive
+    once the writers have released them. """
+
+    plain = write(build_scene(), BAM_VERSION, False)[0]
+
+    cache = BodyCache()
+    scene = build_scene()
+    first = BamWriter(body_cache=cache)
+    second = BamWriter(body_cache=cache)
+    outputs = []
+    for writer in first, second:
+        target = io.BytesIO()
+        writer.open_target(target, magic=True)
+        writer.write_object(scene)
+        writer.release_objects()
+        outputs.append(target.getvalue())
+
+    ref = weakref.ref(scene)
+    del scene
+    gc.collect()
+
+    return outputs == [plain, plain] and cache.hits > 0 and ref() is None
+
+
+def split_datagrams(data):
+    """ Returns the datagrams of a bam stream written with the magic number,
+    without their length prefixes, leaving out the header datagram. """
+
+    datagrams = []
+    pos = len(BAM_MAGIC)
+    while pos < len(data):
+        length, = struct.unpack_from('<I', data, pos)
+        datagrams.append(data[pos + 4:pos + 4 + length])
+        pos += 4 + length
+
+    return datagrams[1:]
+
+
+def build_stream_tile(index):
+    """ Builds a small scene that holds on to no other objects than the
+    registered constants, so that it is destroyed as soon as it is let go. """
+
+    tile = PandaNode("tile%d" % index)
+    tile.transform = TransformState()
+    tile.transform.pos = (index, 0, 0)
+    tile.state = RenderState(ColorAttrib(ColorAttrib.T_flat, (index, 0, 0, 1)))
+    return tile
+
+
+def build_remove(first_ids, block, kept):
+    """ Returns the BOC_remove datagram freeing the IDs assigned in the given
+    block, apart from those that are kept. """
+
+    datagram = bytearray([BOC_remove])
+    for object_id in range(first_ids[block], first_ids[block + 1]):
+        if object_id not in kept:
+            datagram += struct.pack('<H', object_id)
+    return bytes(datagram)
+
+
+def check_write_stream():
+    """ Checks that write_stream writes the same objects with the same IDs
+    as a plain writer that keeps everything, with a BOC_remove datagram for
+    the objects of each root after it, including the last one. """
+
+    count = 3
+    reference = BamWriter()
+    target = io.BytesIO()
+    reference.open_target(target, magic=True)
+    first_ids = []
+    tiles = []
+    for index in range(count):
+        first_ids.append(reference.next_object_id)
+        tiles.append(build_stream_tile(index))
+        reference.write_object(tiles[-1])
+    first_ids.append(reference.next_object_id)
+
+    # The constants stay alive, so their IDs are never freed.
+    kept = set(object_id for object, object_id in reference.object_map.items()
+               if object in constants)
+
+    expected = []
+    block = 0
+    for datagram in split_datagrams(target.getvalue()):
+        if datagram[0] == BOC_push and block > 0:
+            expected.append(build_remove(first_ids, block - 1, kept))
+            block += 1
+        elif datagram[0] == BOC_push:
+            block += 1
+        expected.append(datagram)
+    expected.append(build_remove(first_ids, block - 1, kept))
+
+    writer = BamWriter()
+    target = io.BytesIO()
+    target.close = lambda: None
+    writer.open_target(target, magic=True)
+    written = writer.write_stream(build_stream_tile(index) for index in range(count))
+
+    # There is nothing left to free on close().
+    writer.close()
+    return written == count and split_datagrams(target.getvalue()) == expected
+
+
+def check_tracked_lights():
+    """ Checks that with change tracking enabled, turning on a light in a
+    LightAttrib is picked up by write_changes, which writes the same bytes
+    as writing the attrib again after setting its modified flag by hand. """
+
+    enable_change_tracking()
+    try:
+        node = PandaNode("lit")
+        attrib = LightAttrib()
+        node.state = RenderState(attrib)
+        light = AmbientLight("ambient")
+        node.add_child(light)
+    finally:
+        disable_change_tracking()
+
+    tracked = BamWriter()
+    manual = BamWriter()
+    targets = []
+    for writer in tracked, manual:
+        target = io.BytesIO()
+        writer.open_target(target, magic=True)
+        writer.write_object(node)
+        targets.append(target)
+
+    attrib.on_lights.add(light)
+    changed = tracked.write_changes()
+    attrib.modified = True
+    manual.write_object(attrib)
+
+    tracked, manual = (target.getvalue() for target in targets)
+    return changed == 1 and tracked == manual
+
+
+def check_generations():
+    """ Checks that a modified object is sent again by every writer that has
+    written it, however many others have sent the change before, with the
+    same bytes each time, and that a writer that only wrote it afterwards
+    doesn't send it again. """
+
+    scene = build_scene()
+    writers = [BamWriter(), BamWriter()]
+    targets = []
+    for writer in writers:
+        target = io.BytesIO()
+        writer.open_target(target, magic=True)
+        writer.write_object(scene)
+        targets.append(target)
+    start = targets[0].tell()
+
+    scene.name = "changed"
+    scene.modified = True
+    changed = [writer.write_changes() for writer in writers]
+    again = [writer.write_changes() for writer in writers]
+    tails = [target.getvalue()[start:] for target in targets]
+
+    late = BamWriter()
+    target = io.BytesIO()
+    late.open_target(target, magic=True)
+    late.write_object(scene)
+
+    return changed == [1, 1] and again == [0, 0] and \
+        tails[0] == tails[1] and b"changed" in tails[0] and \
+        late.write_changes() == 0 and \
+        target.getvalue() == write(scene, BAM_VERSION, False)[0]
+
+
+def check_stdfloat_buffers():
+    """ Checks that stdfloats given as raw bytes are written as they are,
+    in either stdfloat mode. """
+
+    for stdfloat_double in False, True:
+        values = array('d' if stdfloat_double else 'f', [0.5, 1.5, 2.5])
+        for buffer in bytes(values), bytearray(values), memoryview(bytes(values)):
+            dg = Datagram(stdfloat_double)
+            dg.add_stdfloat_array(buffer)
+            if dg.data != bytes(values):
+                return False
+
+    return True
+
+
+def receive(server, chunks):
+    """ Accepts one connection on the listening socket and appends all of
+    the data received on it to chunks.  Run on a thread of its own. """
+
+    conn, address = server.accept()
+    with conn:
+        while True:
+            chunk = conn.recv(1 << 16)
+            if not chunk:
+                break
+            chunks.append(chunk)
+
+
+def check_flush_policies():
+    """ Checks that every flush policy of open_socket sends the same bytes
+    as open_target, in the expected number of writes, and that neither it
+    nor open_file changes arena_size. """
+
+    plain = write(build_scene(), BAM_VERSION, False)[0]
+    count = len(split_datagrams(plain))
+
+    # Besides the header, one write per datagram or one for the whole call.
+    expected_writes = {'object': 1 + count, 'call': 2, None: None}
+
+    writer = BamWriter()
+    for flush_policy, writes in expected_writes.items():
+        server = socket.create_server(('127.0.0.1', 0))
+        chunks = []
+        thread = threading.Thread(target=receive, args=(server, chunks))
+        thread.start()
+        writer.open_socket(*server.getsockname(), flush_policy=flush_policy)
+        writer.write_object(build_scene())
+        writer.close()
+        thread.join()
+        server.close()
+
+        received = b''.join(chunks)
+        if received != plain[len(BAM_MAGIC):] or writer.arena_size != 0:
+            return False
+        if writes is not None and writer.metrics.writes != writes:
+            return False
+        writer = writer.clone()
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'check.bam')
+        writer.open_file(filename)
+        writer.write_object(build_scene())
+        writer.close()
+        with open(filename, 'rb') as file:
+            written = file.read()
+
+    return written == plain and writer.arena_size == 0
+
+
+class BroadcastClient(io.BytesIO):
+    """ Keeps what is written to it after it is closed, and can be made to
+    stall on each write until released, to fail after a number of writes,
+    or to take a while over each write. """
+
+    def __init__(self, stall=False, fail_after=None, delay=0):
+        io.BytesIO.__init__(self)
+        self.released = threading.Event()
+        if not stall:
+            self.released.set()
+        self.fail_after = fail_after
+        self.delay = delay
+        self.closed_by_writer = False
+
+    def write(self, data):
+        self.released.wait()
+        if self.fail_after is not None:
+            if self.fail_after == 0:
+                raise BrokenPipeError("client went away")
+            self.fail_after -= 1
+        time.sleep(self.delay)
+        return io.BytesIO.write(self, data)
+
+    def close(self):
+        self.closed_by_writer = True
+
+
+def check_broadcast():
+    """ Checks that open_broadcast sends the same bytes to every client as
+    open_target does, that a client that stalls or fails is disconnected
+    and closed under the 'disconnect' policy without affecting the others,
+    and that a client that falls behind receives everything under the
+    'block' policy, even if the arrays passed to it without copying are
+    changed as soon as they are written. """
+
+    roots = [build_arrays(1, 10000) for i in range(4)]
+    writer = BamWriter()
+    target = io.BytesIO()
+    writer.open_target(target)
+    for root in roots:
+        writer.write_object(root)
+    plain = target.getvalue()
+
+    good = BroadcastClient()
+    stalled = BroadcastClient(stall=True)
+    failing = BroadcastClient(fail_after=2)
+    writer = BamWriter(arena_size=4096)
+    writer.open_broadcast([good, stalled, failing], max_buffered=16384)
+    broadcast = writer.target
+
+    # Should the stalled client not be dropped, don't wait for it forever.
+    timer = threading.Timer(2, stalled.released.set)
+    timer.start()
+    for root in roots:
+        writer.write_object(root)
+        # Each root fits in max_buffered, so unlike the stalled client, the
+        # good one can't fall behind far enough to be dropped if its I/O
+        # thread gets to run in between.
+        time.sleep(0.05)
+    remaining = broadcast.targets
+    writer.close()
+    timer.cancel()
+    stalled.released.set()
+
+    dropped = dict((id(target), error) for target, error in broadcast.dropped)
+    if good.getvalue() != plain or remaining != [good] or len(dropped) != 2:
+        return False
+    if not isinstance(dropped.get(id(stalled)), BufferError) or \
+       not isinstance(dropped.get(id(failing)), BrokenPipeError):
+        return False
+
+    # The I/O thread of the stalled client closes it once it is released.
+    for i in range(100):
+        if stalled.closed_by_writer:
+            break
+        time.sleep(0.01)
+    if not (good.closed_by_writer and stalled.closed_by_writer and
+            failing.closed_by_writer):
+        return False
+
+    slow = BroadcastClient(delay=0.01)
+    writer = BamWriter(arena_size=4096, zero_copy_threshold=64)
+    writer.open_broadcast([slow], policy='block')
+    broadcast = writer.target
+    for root in roots:
+        writer.write_object(root)
+        geom, state = root.children[0].geoms[0]
+        geom.data.arrays[0].buffer[:] = b'\xff' * 10000
+    writer.close()
+    return slow.getvalue() == plain and not broadcast.dropped
+
+def read_ring(name, conn):
+    """ Reads the whole stream from the ring buffer of the given name and
+    sends it over the pipe.  Run in a process of its own. """
+
+    reader = RingBufferReader(name)
+    data = bytearray()
+    chunk = reader.read()
+    while chunk:
+        data += chunk
+        chunk = reader.read()
+    reader.close()
+    conn.send(bytes(data))
+
+
+def read_ring_and_crash(name, conn):
+    """ Reads the start of the stream from the ring buffer of the given name
+    and sends it over the pipe, then exits without closing the reader. """
+
+    reader = RingBufferReader(name)
+    conn.send(bytes(reader.read_exactly(16)))
+    os._exit(1)
+
+
+def write_ring_and_crash(conn):
+    """ Writes a scene to a new ring buffer, whose name is sent over the
+    pipe, then exits without closing the writer. """
+
+    writer = BamWriter()
+    conn.send(writer.open_shared_memory(capacity=1 << 12))
+    writer.write_object(build_arrays(3, 10000))
+    os._exit(1)
+
+
+def check_ring_buffer():
+    """ Checks that a reader in another process receives the same bytes
+    through a ring buffer that wraps around as are written to a file, also
+    when the writer exits without closing it, in which case the reader gets
+    EOFError at the end; and that the writer gets BrokenPipeError when the
+    reader exits, or TimeoutError when there is none, without leaving the
+    shared memory behind. """
+
+    plain = write(build_arrays(3, 10000), BAM_VERSION, False)[0]
+    plain = plain[len(BAM_MAGIC):]
+    context = multiprocessing.get_context('spawn')
+
+    writer = BamWriter()
+    name = writer.open_shared_memory(capacity=1 << 12)
+    conn, child_conn = context.Pipe()
+    process = context.Process(target=read_ring, args=(name, child_conn))
+    process.start()
+    writer.write_object(build_arrays(3, 10000))
+    writer.close()
+    received = conn.recv()
+    process.join()
+    if received != plain:
+        return False
+
+    writer = BamWriter()
+    name = writer.open_shared_memory(capacity=1 << 12)
+    process = context.Process(target=read_ring_and_crash, args=(name, child_conn))
+    process.start()
+    try:
+        writer.write_object(build_arrays(3, 10000))
+        return False
+    except BrokenPipeError:
+        pass
+    try:
+        writer.close()
+    except BrokenPipeError:
+        pass
+    received = conn.recv()
+    process.join()
+    if received != plain[:16]:
+        return False
+
+    writer = BamWriter()
+    name = writer.open_shared_memory(capacity=1 << 12, timeout=0.2)
+    try:
+        writer.write_object(build_arrays(3, 10000))
+        return False
+    except TimeoutError:
+        pass
+    try:
+        writer.close()
+    except TimeoutError:
+        pass
+    try:
+        RingBufferReader(name).close()
+        return False
+    except FileNotFoundError:
+        pass
+
+    process = context.Process(target=write_ring_and_crash, args=(child_conn,))
+    process.start()
+    reader = RingBufferReader(conn.recv())
+    received = bytearray()
+    try:
+        while True:
+            received += reader.read()
+    except EOFError:
+        pass
+    reader.close()
+    process.join()
+    return received == plain
+
+
+# Checks that don't depend on the file version.
+CHECKS = [check_budget, check_cache_release, check_write_stream,
+          check_tracked_lights, check_generations, check_stdfloat_buffers,
+          check_flush_policies, check_broadcast, check_ring_buffer]
+
+
+if __name__ == '__main__':
+    failed = False
+    for file_version, stdfloat_double in CONFIGS:
+        checks = [('compiled serializers', check_serializers)]
+        if file_version >= (6, 21):
+            checks.append(('merge', check_merge))
+
+        for name, check in checks:
+            identical = check(file_version, stdfloat_double)
+            failed |= not identical
+            mode = 'double' if stdfloat_double else 'float'
+            result = 'identical' if identical else 'DIFFERENT'
+            print("%d.%d %s %s: %s" % (*file_version, mode, name, result))
+
+    for check in CHECKS:
+        passed = check()
+        failed |= not passed
+        print("%s: %s" % (check.__name__[6:], 'ok' if passed else 'FAILED'))
+
+    if failed:
+        raise SystemExit("output differs")
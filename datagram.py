@@ -1,67 +1,562 @@
-from struct import pack
+from struct import Struct
+from array import array
+from itertools import chain
+import errno
+import sys
+import os
+
+# Precompiled packers for the fixed-size fields.
+_pack_int8 = Struct('<b').pack
+_pack_int16 = Struct('<h').pack
+_pack_int32 = Struct('<i').pack
+_pack_int64 = Struct('<q').pack
+_pack_uint8 = Struct('<B').pack
+_pack_uint16 = Struct('<H').pack
+_pack_uint32 = Struct('<I').pack
+_pack_uint64 = Struct('<Q').pack
+_pack_float32 = Struct('<f').pack
+_pack_float64 = Struct('<d').pack
+
+_pack_into_uint32 = Struct('<I').pack_into
+
+# Packers for a stdfloat, vec2, vec3, vec4 and mat4, keyed by stdfloat_double.
+_stdfloat_packers = {
+    False: tuple(Struct('<' + 'f' * n).pack for n in (1, 2, 3, 4, 16)),
+    True: tuple(Struct('<' + 'd' * n).pack for n in (1, 2, 3, 4, 16)),
+}
+
+_little_endian = sys.byteorder == 'little'
+
+# Buffer formats of raw bytes, which stdfloat arrays are reinterpreted from.
+_byte_formats = frozenset(('B', 'b', 'c'))
+
+
+def _stdfloat_view(view, typecode):
+    """ Returns the memoryview of a buffer passed as stdfloats, cast to the
+    given stdfloat typecode if it holds raw bytes, and flattened. """
+
+    if view.format in _byte_formats:
+        itemsize = 8 if typecode == 'd' else 4
+        if view.nbytes % itemsize != 0:
+            raise ValueError("buffer of %d bytes does not hold a whole number "
+                             "of %d-byte stdfloats" % (view.nbytes, itemsize))
+        return view.cast('B').cast(typecode)
+
+    if view.ndim != 1:
+        return view.cast('B').cast(view.format)
+
+    return view
+
+# Errors indicating that a way of copying between file descriptors is not
+# supported for this pair of files, so that the next one should be tried.
+_COPY_FALLBACK_ERRNOS = frozenset((
+    errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EBADF,
+    getattr(errno, 'EOPNOTSUPP', errno.EINVAL),
+))
+
+# Size of the chunks in which a FileRegion is read when it has to be copied
+# through user space.
+_COPY_CHUNK_SIZE = 1 << 20
+
+
+class FileRegion(object):
+    """ Refers to length bytes at the given offset of a file, which may be
+    given as a filename or as an open binary file object.  May be used in
+    place of a bytearray as the buffer of a GeomVertexArrayData, or of an
+    array passed to BamWriter.write_pta, such as the ends of a
+    GeomPrimitive, if the bytes are already stored on disk in the right
+    layout.  In the latter case, itemsize must be set to the size of each
+    element, as for the array it replaces, since a PTA is written with its
+    number of elements.
+
+    Such a region is never read into memory as a whole.  When the target is
+    backed by a file descriptor, the bytes are copied by the kernel using
+    os.copy_file_range or os.sendfile; otherwise they are read and written
+    in chunks of 1 MiB. """
+
+    __slots__ = ('file', 'offset', 'length', 'itemsize')
+
+    def __init__(self, file, offset=0, length=None, itemsize=1):
+        self.file = file
+        self.offset = offset
+        self.itemsize = itemsize
+
+        if length is None:
+            with self.__open() as fd:
+                length = os.fstat(fd).st_size - offset
+        self.length = length
+
+        if length % itemsize != 0:
+            raise ValueError("file region length is not a multiple of itemsize")
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def nbytes(self):
+        return self.length
+
+    def read(self):
+        """ Returns the contents of the region as a bytes object. """
+
+        with self.__open() as fd:
+            chunks = []
+            for offset, size in self.__chunks():
+                chunks.append(self.__pread(fd, offset, size))
+            return b''.join(chunks)
+
+    def write_to(self, target):
+        """ Writes the contents of the region to the given file object,
+        passing them through user space in chunks. """
+
+        with self.__open() as fd:
+            for offset, size in self.__chunks():
+                target.write(self.__pread(fd, offset, size))
+
+    def copy_to_fd(self, out_fd):
+        """ Copies the contents of the region to the current position of
+        the given file descriptor, preferably without them passing through
+        user space. """
+
+        with self.__open() as fd:
+            offset = self.offset
+            end = offset + self.length
+
+            for method in _copy_methods:
+                try:
+                    while offset < end:
+                        copied = method(fd, out_fd, offset, end - offset)
+                        if copied == 0:
+                            raise EOFError("file region extends past the end of the file")
+                        offset += copied
+                    return
+
+                except OSError as ex:
+                    if ex.errno not in _COPY_FALLBACK_ERRNOS or method is _copy_read_write:
+                        raise
+
+    def __chunks(self):
+        offset = self.offset
+        end = offset + self.length
+        while offset < end:
+            size = min(end - offset, _COPY_CHUNK_SIZE)
+            yield offset, size
+            offset += size
+
+    def __pread(self, fd, offset, size):
+        data = os.pread(fd, size, offset)
+        if len(data) < size:
+            raise EOFError("file region extends past the end of the file")
+        return data
+
+    def __open(self):
+        file = self.file
+        if isinstance(file, (str, bytes, os.PathLike)):
+            return _OpenedFile(os.open(file, os.O_RDONLY), True)
+        else:
+            return _OpenedFile(file.fileno(), False)
+
+
+class _OpenedFile(object):
+    """ Context manager yielding a file descriptor, and closing it afterwards
+    if we opened it ourselves. """
+
+    __slots__ = ('fd', 'owned')
+
+    def __init__(self, fd, owned):
+        self.fd = fd
+        self.owned = owned
+
+    def __enter__(self):
+        return self.fd
+
+    def __exit__(self, *exc_info):
+        if self.owned:
+            os.close(self.fd)
+
+
+def _copy_read_write(in_fd, out_fd, offset, count):
+    data = os.pread(in_fd, min(count, _COPY_CHUNK_SIZE), offset)
+    view = memoryview(data)
+    while view:
+        view = view[os.write(out_fd, view):]
+    return len(data)
+
+
+def _copy_file_range(in_fd, out_fd, offset, count):
+    return os.copy_file_range(in_fd, out_fd, count, offset)
+
+
+def _sendfile(in_fd, out_fd, offset, count):
+    return os.sendfile(out_fd, in_fd, offset, count)
+
+
+# The ways of copying a FileRegion, in order of preference.
+_copy_methods = []
+if hasattr(os, 'copy_file_range'):
+    _copy_methods.append(_copy_file_range)
+if hasattr(os, 'sendfile'):
+    _copy_methods.append(_sendfile)
+_copy_methods.append(_copy_read_write)
+
 
 class Datagram(object):
     """ Reimplementation of Panda's Datagram in Python. """
 
-    __slots__ = ('data', 'stdfloat_format')
+    __slots__ = ('data', 'segments', 'external_length', 'zero_copy_threshold',
+                 'stdfloat_format', '_pack_stdfloat', '_pack_vec2',
+                 '_pack_vec3', '_pack_vec4', '_pack_mat4')
 
     def __init__(self, stdfloat_double=False):
         self.data = bytearray()
+        self.set_stdfloat_double(stdfloat_double)
+
+        # Buffers passed to append_data() that are at least this many bytes
+        # long are not copied into the datagram, but referenced as segments,
+        # each stored as an (offset into data, memoryview) pair.  The caller
+        # must not modify those buffers until they have been written out.
+        # FileRegions are always referenced this way, regardless of size.
+        self.zero_copy_threshold = None
+        self.segments = []
+        self.external_length = 0
+
+    def set_stdfloat_double(self, stdfloat_double):
+        """ Changes whether stdfloats are written as 64-bit or 32-bit values
+        from now on. """
+
         self.stdfloat_format = 'd' if stdfloat_double else 'f'
 
+        (self._pack_stdfloat, self._pack_vec2, self._pack_vec3,
+         self._pack_vec4, self._pack_mat4) = _stdfloat_packers[bool(stdfloat_double)]
+
+    def get_length(self):
+        return len(self.data) + self.external_length
+
+    def get_buffers(self):
+        """ Returns the contents of the datagram as a list of buffers, with
+        any referenced segments in between slices of the inline data. """
+
+        if not self.segments:
+            return [self.data]
+
+        buffers = []
+        view = memoryview(self.data)
+        start = 0
+        for pos, segment in self.segments:
+            if pos > start:
+                buffers.append(view[start:pos])
+            buffers.append(segment)
+            start = pos
+
+        if start < len(self.data):
+            buffers.append(view[start:])
+
+        return buffers
+
+    def clear(self):
+        # Start over with fresh storage rather than truncating, so that
+        # buffers previously returned by get_buffers() stay intact for
+        # whoever may still be holding on to them.
+        self.data = bytearray()
+
+        if self.segments:
+            self.segments = []
+            self.external_length = 0
+
+    def begin_datagram(self):
+        """ Starts a nested, length-prefixed datagram at the end of this one,
+        as when encoding a stream of datagrams into a single buffer.  Returns
+        a marker that must be passed to end_datagram() once the contents of
+        the nested datagram have been added. """
+
+        marker = len(self.data)
+        self.data += b'\0\0\0\0'
+        return marker
+
+    def end_datagram(self, marker):
+        """ Fills in the length prefix reserved by begin_datagram(). """
+
+        length = len(self.data) - marker - 4
+
+        # Count the segments that were referenced since begin_datagram().
+        segments = self.segments
+        i = len(segments) - 1
+        while i >= 0 and segments[i][0] > marker:
+            length += segments[i][1].nbytes
+            i -= 1
+
+        _pack_into_uint32(self.data, marker, length)
 
     def add_bool(self, value):
         self.data.append(int(bool(value)))
 
     def add_int8(self, value):
-        self.data += pack('<b', value)
+        self.data += _pack_int8(value)
 
     def add_int16(self, value):
-        self.data += pack('<h', value)
+        self.data += _pack_int16(value)
 
     def add_int32(self, value):
-        self.data += pack('<i', value)
+        self.data += _pack_int32(value)
 
     def add_int64(self, value):
-        self.data += pack('<q', value)
+        self.data += _pack_int64(value)
 
     def add_uint8(self, value):
-        self.data += pack('<B', value)
+        self.data += _pack_uint8(value)
 
     def add_uint16(self, value):
-        self.data += pack('<H', value)
+        self.data += _pack_uint16(value)
 
     def add_uint32(self, value):
-        self.data += pack('<I', value)
+        self.data += _pack_uint32(value)
 
     def add_uint64(self, value):
-        self.data += pack('<Q', value)
+        self.data += _pack_uint64(value)
 
     def add_float32(self, value):
-        self.data += pack('<f', value)
+        self.data += _pack_float32(value)
 
     def add_float64(self, value):
-        self.data += pack('<d', value)
+        self.data += _pack_float64(value)
 
     def add_stdfloat(self, value):
-        self.data += pack('<' + self.stdfloat_format, value)
+        self.data += self._pack_stdfloat(value)
 
     def add_vec2(self, vec):
-        self.data += pack('<' + self.stdfloat_format * 2, *vec)
+        self.data += self._pack_vec2(*vec)
 
     def add_vec3(self, vec):
-        self.data += pack('<' + self.stdfloat_format * 3, *vec)
+        self.data += self._pack_vec3(*vec)
 
     def add_vec4(self, vec):
-        self.data += pack('<' + self.stdfloat_format * 4, *vec)
+        self.data += self._pack_vec4(*vec)
+
+    def add_mat4(self, mat):
+        """ Adds a 4x4 matrix, given as a sequence of four rows, in the
+        column-major order used by the bam format. """
+        r0, r1, r2, r3 = mat
+        self.data += self._pack_mat4(r0[0], r1[0], r2[0], r3[0],
+                                     r0[1], r1[1], r2[1], r3[1],
+                                     r0[2], r1[2], r2[2], r3[2],
+                                     r0[3], r1[3], r2[3], r3[3])
+
+    def add_stdfloat_array(self, values):
+        """ Adds a flat run of stdfloats.  The values may be any sequence of
+        numbers, an array.array or another buffer object; arrays and buffers
+        that are already in the stdfloat format are appended directly.  A
+        buffer of raw bytes, such as bytes or bytearray, is taken to hold the
+        stdfloats in their binary form. """
+
+        typecode = self.stdfloat_format
+
+        if not isinstance(values, array):
+            try:
+                view = memoryview(values)
+            except TypeError:
+                pass
+            else:
+                view = _stdfloat_view(view, typecode)
+                if view.format == typecode and _little_endian:
+                    self.data += view
+                    return
+                values = view
+
+        if getattr(values, 'typecode', None) != typecode or not _little_endian:
+            values = array(typecode, values)
+
+        if not _little_endian:
+            values.byteswap()
+
+        self.data += values
+
+    def add_vec2_array(self, vecs):
+        """ Adds a run of vec2s, given either as a sequence of pairs or as a
+        flat array or buffer of stdfloats. """
+        self.__add_vec_array(vecs, 2)
+
+    def add_vec3_array(self, vecs):
+        """ Like add_vec2_array, but for vec3s. """
+        self.__add_vec_array(vecs, 3)
+
+    def add_vec4_array(self, vecs):
+        """ Like add_vec2_array, but for vec4s. """
+        self.__add_vec_array(vecs, 4)
+
+    def __add_vec_array(self, vecs, num_components):
+        if isinstance(vecs, array):
+            assert len(vecs) % num_components == 0
+            self.add_stdfloat_array(vecs)
+            return
+
+        try:
+            view = memoryview(vecs)
+        except TypeError:
+            # A sequence of vectors; flatten it into a single array.
+            flat = array(self.stdfloat_format, chain.from_iterable(vecs))
+            assert len(flat) == len(vecs) * num_components
+            self.add_stdfloat_array(flat)
+        else:
+            view = _stdfloat_view(view, self.stdfloat_format)
+            assert len(view) % num_components == 0
+            self.add_stdfloat_array(view)
+
+    def append_data(self, data):
+        """ Appends the raw contents of a bytes-like object or FileRegion. """
+
+        if isinstance(data, FileRegion):
+            self.segments.append((len(self.data), data))
+            self.external_length += data.length
+            return
+
+        threshold = self.zero_copy_threshold
+        if threshold is not None:
+            view = memoryview(data).cast('B')
+            if view.nbytes >= threshold:
+                self.segments.append((len(self.data), view))
+                self.external_length += view.nbytes
+                return
+            view.release()
+
+        self.data += data
 
     def add_string(self, value):
         if isinstance(value, str):
             value = value.encode('utf-8')
 
         assert len(value) <= 65535
-        self.data += pack('<H', len(value))
+        self.data += _pack_uint16(len(value))
         self.data += value
 
     def __bytes__(self):
-        return pack('<I', len(self.data)) + self.data
+        if self.segments:
+            buffers = [buffer.read() if isinstance(buffer, FileRegion) else buffer
+                       for buffer in self.get_buffers()]
+            return b''.join([_pack_uint32(self.get_length())] + buffers)
+
+        return _pack_uint32(len(self.data)) + self.data
+
+
+class CountingDatagram(Datagram):
+    """ A Datagram that does not store anything, but only keeps track of how
+    many bytes would have been added to it.  Used to determine the size of
+    the output without actually encoding it. """
+
+    __slots__ = ('length', 'stdfloat_size')
+
+    def __init__(self, stdfloat_double=False):
+        super().__init__(stdfloat_double)
+        self.length = 0
+
+    def set_stdfloat_double(self, stdfloat_double):
+        super().set_stdfloat_double(stdfloat_double)
+        self.stdfloat_size = 8 if stdfloat_double else 4
+
+    def get_length(self):
+        return self.length
+
+    def get_buffers(self):
+        return []
+
+    def clear(self):
+        self.length = 0
+
+    def begin_datagram(self):
+        marker = self.length
+        self.length += 4
+        return marker
+
+    def end_datagram(self, marker):
+        pass
+
+    def add_bool(self, value):
+        self.length += 1
+
+    def add_int8(self, value):
+        self.length += 1
+
+    def add_int16(self, value):
+        self.length += 2
+
+    def add_int32(self, value):
+        self.length += 4
+
+    def add_int64(self, value):
+        self.length += 8
+
+    add_uint8 = add_int8
+    add_uint16 = add_int16
+    add_uint32 = add_int32
+    add_uint64 = add_int64
+    add_float32 = add_int32
+    add_float64 = add_int64
+
+    def add_stdfloat(self, value):
+        self.length += self.stdfloat_size
+
+    def add_vec2(self, vec):
+        self.length += self.stdfloat_size * 2
+
+    def add_vec3(self, vec):
+        self.length += self.stdfloat_size * 3
+
+    def add_vec4(self, vec):
+        self.length += self.stdfloat_size * 4
+
+    def add_mat4(self, mat):
+        self.length += self.stdfloat_size * 16
+
+    def add_stdfloat_array(self, values):
+        if isinstance(values, array):
+            count = len(values)
+        else:
+            try:
+                view = memoryview(values)
+            except TypeError:
+                try:
+                    count = len(values)
+                except TypeError:
+                    count = sum(1 for value in values)
+            else:
+                count = len(_stdfloat_view(view, self.stdfloat_format))
+
+        self.length += count * self.stdfloat_size
+
+    def add_vec2_array(self, vecs):
+        self.__add_vec_array(vecs, 2)
+
+    def add_vec3_array(self, vecs):
+        self.__add_vec_array(vecs, 3)
+
+    def add_vec4_array(self, vecs):
+        self.__add_vec_array(vecs, 4)
+
+    def __add_vec_array(self, vecs, num_components):
+        if isinstance(vecs, array):
+            self.length += len(vecs) * self.stdfloat_size
+            return
+
+        try:
+            view = memoryview(vecs)
+        except TypeError:
+            self.length += len(vecs) * num_components * self.stdfloat_size
+        else:
+            view = _stdfloat_view(view, self.stdfloat_format)
+            self.length += len(view) * self.stdfloat_size
+
+    def append_data(self, data):
+        if isinstance(data, (bytes, bytearray, FileRegion)):
+            self.length += len(data)
+        else:
+            with memoryview(data) as view:
+                self.length += view.nbytes
+
+    def add_string(self, value):
+        if isinstance(value, str) and not value.isascii():
+            value = value.encode('utf-8')
+
+        assert len(value) <= 65535
+        self.length += 2 + len(value)
+
+    def __bytes__(self):
+        raise TypeError("a CountingDatagram has no contents")
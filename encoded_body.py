@@ -0,0 +1,365 @@
+""" Encoded forms of the bodies of objects, which a BamWriter can write out
+again without calling their write_datagram methods. """
+
+__all__ = ['EncodedBody', 'BodyCache', 'register_constant',
+           'unregister_constant', 'constants']
+
+from .datagram import Datagram
+from array import array
+from collections import OrderedDict
+from copy import copy
+import operator
+import weakref
+
+# Registered constants, mapped to objects holding their cached bodies,
+# which provide a get_body(object, (file_version, stdfloat_double)) method.
+# Only to be changed through register_constant and unregister_constant.
+constants = {}
+
+# Functions returning the state of an object of a given class, as compared
+# by _Constant.get_body; see _get_state_getter.
+_state_getters = {}
+
+
+def register_constant(object):
+    """ Registers an object that is not expected to change, such as
+    RenderState.empty, so that every BamWriter writes a body cached for its
+    file version and stdfloat mode rather than calling write_datagram.
+
+    The object is not required to be immutable: if any of its attributes
+    is assigned, or the contents of a list, dict, set or array held by one
+    are modified, the cached bodies are discarded and encoded again the
+    next time.  Changes inside other objects held by it are not detected,
+    which does not matter for the objects it points to, since those are
+    written separately. """
+
+    if object not in constants:
+        constants[object] = _Constant(object)
+
+
+def unregister_constant(object):
+    """ Undoes register_constant. """
+
+    constants.pop(object, None)
+
+
+class EncodedBody(object):
+    """ The body of the datagram of an object, as written by its
+    write_datagram method for a particular file version and stdfloat mode.
+
+    Whatever the object writes through the manager, that is, pointers, PTAs
+    and internal names, is kept as a reference rather than encoded, since
+    the encoding depends on the state of the writer.  write() passes these
+    on to the writer again, in between the chunks of encoded data. """
+
+    __slots__ = 'data', 'refs', 'size'
+
+    def __init__(self, data, refs, size=None):
+        self.data = data
+        self.refs = refs
+        if size is None:
+            size = len(data) + sum(len(chunk) for method, value, chunk in refs)
+        self.size = size
+
+    @classmethod
+    def encode(cls, object, file_version, stdfloat_double=False):
+        """ Returns the encoded body of the given object, or None if it
+        can't be stored in this form, because it refers to a FileRegion. """
+
+        dg = Datagram(stdfloat_double)
+        recorder = _Recorder(dg, file_version, stdfloat_double)
+        object.write_datagram(recorder, dg)
+
+        if dg.segments:
+            return None
+
+        return cls(*recorder.finish())
+
+    def write(self, manager, dg):
+        """ Appends the body to the datagram, as if write_datagram had been
+        called with the given manager. """
+
+        if self.data:
+            dg.append_data(self.data)
+
+        # Each reference is stored as a (method name, argument, data) tuple,
+        # where data is what was written after it.
+        for method, value, data in self.refs:
+            getattr(manager, method)(dg, value)
+            if data:
+                dg.append_data(data)
+
+
+class BodyCache(object):
+    """ Keeps the encoded bodies of the objects written by one or more
+    BamWriters, so that writing an unchanged object again, whether to the
+    same stream or to another, appends the cached data rather than calling
+    write_datagram.  Passed to BamWriter as body_cache.
+
+    An object is encoded again whenever its generation has changed, that
+    is, when its modified flag has been set since it was cached.  Objects
+    are only weakly referenced, so that the cache doesn't keep them alive;
+    the bodies of objects that have been destroyed are dropped.
+
+    The bodies are kept up to a total of roughly max_bytes, after which the
+    least recently used ones are evicted.  Note that a body includes a copy
+    of any vertex or image data written by the object. """
+
+    # Rough estimate of the memory used by an entry, besides its data.
+    ENTRY_OVERHEAD = 128
+
+    def __init__(self, max_bytes=1 << 26):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+        # Maps (id(object), file_version, stdfloat_double) to a _CacheEntry,
+        # from least to most recently used.
+        self.__entries = OrderedDict()
+
+        # Entries whose objects have been destroyed, appended by the weakref
+        # callbacks, and removed on the next call; removing them right away
+        # could happen in the middle of changing the entries.
+        self.__dead = []
+
+    def __len__(self):
+        self.__drop_dead()
+        return len(self.__entries)
+
+    def get_body(self, object, key):
+        """ Returns the body of the given object for the given (file_version,
+        stdfloat_double) pair, encoding it first if it isn't cached or the
+        object has been modified since.  Returns None if the object can't
+        be encoded this way. """
+
+        if self.__dead:
+            self.__drop_dead()
+
+        entries = self.__entries
+        entry_key = (id(object),) + key
+        generation = getattr(object, 'generation', None)
+
+        entry = entries.get(entry_key)
+        if entry is not None and entry.generation == generation and entry() is object:
+            entries.move_to_end(entry_key)
+            self.hits += 1
+            return entry.body
+
+        self.misses += 1
+        self.__remove(entry_key)
+
+        body = EncodedBody.encode(object, *key)
+        size = self.__get_size(body)
+        if size <= self.max_bytes:
+            cached = _CachedBody.from_body(body) if body is not None else None
+            entries[entry_key] = _CacheEntry(object, self.__dead.append,
+                                             entry_key, generation, cached)
+            self.size += size
+            while self.size > self.max_bytes:
+                self.__evict()
+
+        return body
+
+    def discard(self, entry_key):
+        """ Removes the body cached for the given (object, file_version,
+        stdfloat_double) tuple, if any. """
+
+        object, file_version, stdfloat_double = entry_key
+        entry = self.__entries.get((id(object), file_version, stdfloat_double))
+        if entry is not None and entry() is object:
+            self.__remove(entry.key)
+
+    def clear(self):
+        self.__entries.clear()
+        self.size = 0
+
+    def __remove(self, entry_key):
+        entry = self.__entries.pop(entry_key, None)
+        if entry is not None:
+            self.size -= self.__get_size(entry.body)
+
+    def __drop_dead(self):
+        # The list may grow while this runs, as its items are appended by
+        # weakref callbacks.
+        count = len(self.__dead)
+        dead = self.__dead[:count]
+        del self.__dead[:count]
+
+        entries = self.__entries
+        for entry in dead:
+            if entries.get(entry.key) is entry:
+                self.__remove(entry.key)
+
+    def __evict(self):
+        entry_key, entry = self.__entries.popitem(last=False)
+        self.size -= self.__get_size(entry.body)
+
+    def __get_size(self, body):
+        return self.ENTRY_OVERHEAD + (body.size if body is not None else 0)
+
+
+class _CachedBody(EncodedBody):
+    """ An EncodedBody kept by a BodyCache, which only weakly references the
+    objects it points to.  Otherwise, since the body of a node points to its
+    children and theirs point back to it, the cache would keep all of them
+    alive for as long as any of their bodies are cached. """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_body(cls, body):
+        refs = [(method, weakref.ref(value), data)
+                if method == 'write_pointer' and value is not None
+                else (method, value, data)
+                for method, value, data in body.refs]
+        return cls(body.data, refs, body.size)
+
+    def write(self, manager, dg):
+        if self.data:
+            dg.append_data(self.data)
+
+        for method, value, data in self.refs:
+            if method == 'write_pointer' and value is not None:
+                value = value()
+                if value is None:
+                    # The object can only have let go of it by changing.
+                    raise ReferenceError("an object was changed without "
+                                         "setting its modified flag")
+            getattr(manager, method)(dg, value)
+            if data:
+                dg.append_data(data)
+
+
+class _CacheEntry(weakref.ref):
+    """ A weak reference to an object in a BodyCache, along with the key it
+    is stored under and its generation and body when it was cached. """
+
+    __slots__ = 'key', 'generation', 'body'
+
+    def __new__(cls, object, callback, key, generation, body):
+        return super().__new__(cls, object, callback)
+
+    def __init__(self, object, callback, key, generation, body):
+        super().__init__(object, callback)
+        self.key = key
+        self.generation = generation
+        self.body = body
+
+
+class _Recorder(object):
+    """ Stands in for the BamWriter while an object encodes its body,
+    noting where in the datagram each reference occurs. """
+
+    def __init__(self, dg, file_version, stdfloat_double):
+        self.file_version = file_version
+        self.file_stdfloat_double = stdfloat_double
+        self.__dg = dg
+        self.__refs = []
+
+    def write_pointer(self, dg, object):
+        self.__refs.append(('write_pointer', object, len(dg.data)))
+
+    def write_pta(self, dg, array_data):
+        self.__refs.append(('write_pta', array_data, len(dg.data)))
+
+    def write_internal_name(self, dg, string):
+        self.__refs.append(('write_internal_name', string, len(dg.data)))
+
+    def finish(self):
+        """ Returns the arguments for the EncodedBody constructor, cutting
+        the data into chunks at the positions of the references. """
+
+        data = bytes(self.__dg.data)
+        refs = self.__refs
+        if not refs:
+            return data, refs, len(data)
+
+        chunks = []
+        end = len(data)
+        for method, value, pos in reversed(refs):
+            chunks.append((method, value, data[pos:end]))
+            end = pos
+        chunks.reverse()
+        return data[:end], chunks, len(data)
+
+
+class _Constant(object):
+    """ The cached bodies of a registered constant, along with a copy of
+    its state at the time they were encoded. """
+
+    __slots__ = 'get_state', 'state', 'bodies'
+
+    def __init__(self, object):
+        self.get_state = _get_state_getter(type(object))
+        self.state = None
+        self.bodies = {}
+
+    def get_body(self, object, key):
+        try:
+            state = self.get_state(object)
+        except AttributeError:
+            # Leave objects with unset attributes to write_datagram.
+            return None
+
+        if state != self.state:
+            self.state = tuple(map(_copy_value, state))
+            self.bodies = {}
+
+        try:
+            return self.bodies[key]
+        except KeyError:
+            body = EncodedBody.encode(object, *key)
+            self.bodies[key] = body
+            return body
+
+
+def _get_state_getter(cls):
+    """ Returns a function that returns the state of an object of the given
+    class as a tuple: its attributes, including its generation but not its
+    modified flag, which writers reset, and its __dict__, if it has one. """
+
+    getter = _state_getters.get(cls)
+    if getter is not None:
+        return getter
+
+    names = []
+    for base in reversed(cls.__mro__):
+        slots = base.__dict__.get('__slots__', ())
+        if isinstance(slots, str):
+            slots = (slots,)
+        for name in slots:
+            if name == '__dict__':
+                continue
+            if name.startswith('__') and not name.endswith('__'):
+                name = '_%s%s' % (base.__name__.lstrip('_'), name)
+            if name not in ('_modified', '__weakref__') and name not in names:
+                names.append(name)
+
+    if '__dict__' in dir(cls):
+        names.append('__dict__')
+
+    if names:
+        get_attrs = operator.attrgetter(*names)
+        if len(names) == 1:
+            getter = lambda object: (get_attrs(object), )
+        else:
+            getter = get_attrs
+    else:
+        getter = lambda object: ()
+
+    _state_getters[cls] = getter
+    return getter
+
+
+def _copy_value(value):
+    """ Copies the containers that may be modified in place, so that a
+    later comparison detects any change to their contents. """
+
+    if isinstance(value, list):
+        return [_copy_value(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _copy_value(item) for key, item in value.items()}
+    if isinstance(value, (set, bytearray, array)):
+        return copy(value)
+    return value
@@ -89,8 +89,6 @@ class AnimChannelMatrixXfmTable(AnimChannelMatrix):
 
         assert len(self.tables) == 12
 
-        add_stdfloat = dg.add_stdfloat
         for table in self.tables:
             dg.add_uint16(len(table))
-            for entry in table:
-                add_stdfloat(entry)
+            dg.add_stdfloat_array(table)
@@ -81,9 +81,7 @@ class PartBundle(PartGroup):
         dg.add_bool(self.anim_blend_flag)
         dg.add_bool(self.frame_blend_flag)
 
-        for i in (0, 1, 2, 3):
-            for j in (0, 1, 2, 3):
-                dg.add_stdfloat(self.root_xform[j][i])
+        dg.add_mat4(self.root_xform)
 
 
 class CharacterJointBundle(PartBundle):
@@ -115,13 +113,8 @@ class MovingPartMatrix(MovingPartBase):
     def write_datagram(self, manager, dg):
         super().write_datagram(manager, dg)
 
-        for i in (0, 1, 2, 3):
-            for j in (0, 1, 2, 3):
-                dg.add_stdfloat(self.value[j][i])
-
-        for i in (0, 1, 2, 3):
-            for j in (0, 1, 2, 3):
-                dg.add_stdfloat(self.default_value[j][i])
+        dg.add_mat4(self.value)
+        dg.add_mat4(self.default_value)
 
 
 class CharacterJoint(MovingPartMatrix):
@@ -143,9 +136,7 @@ class CharacterJoint(MovingPartMatrix):
         dg.add_uint16(0) # net nodes
         dg.add_uint16(0) # local nodes
 
-        for i in (0, 1, 2, 3):
-            for j in (0, 1, 2, 3):
-                dg.add_stdfloat(self.initial_net_transform_inverse[j][i])
+        dg.add_mat4(self.initial_net_transform_inverse)
 
 
 class JointVertexTransform(VertexTransform):
@@ -245,11 +245,7 @@ class CollisionPolygon(CollisionPlane):
 
         dg.add_uint16(len(self._points))
 
-        for p, v in zip(self._points, self._vectors):
-            dg.add_vec2(p)
-            dg.add_vec2(v)
-
-        dg.add_vec4(self._to_2d_mat[0])
-        dg.add_vec4(self._to_2d_mat[1])
-        dg.add_vec4(self._to_2d_mat[2])
-        dg.add_vec4(self._to_2d_mat[3])
+        # Each point is followed by the normalized vector to the next point.
+        dg.add_vec2_array([vec for pair in zip(self._points, self._vectors) for vec in pair])
+
+        dg.add_vec4_array(self._to_2d_mat)
@@ -111,7 +111,7 @@ class GeomVertexArrayData(CopyOnWriteObject):
         manager.write_pointer(dg, self.array_format)
         dg.add_uint8(self.usage_hint)
         dg.add_uint32(len(self.buffer))
-        dg.data += self.buffer
+        dg.append_data(self.buffer)
 
 
 class GeomVertexFormat(TypedWritableReferenceCount):
@@ -341,6 +341,7 @@ class TransformBlend:
 class TransformBlendTable(CopyOnWriteObject):
 
     def __init__(self):
+        super().__init__()
         self.blends = []
         self._map = {}
         self.rows = None
@@ -114,15 +114,11 @@ class Lens(TypedWritableReferenceCount):
             dg.add_vec3(self.view_vector)
             dg.add_vec3(self.up_vector)
         if self.view_mat:
-            for i in (0, 1, 2, 3):
-                for j in (0, 1, 2, 3):
-                    dg.add_stdfloat(self.view_mat[j][i])
+            dg.add_mat4(self.view_mat)
         if self.keystone:
             dg.add_vec2(self.keystone)
         if self.custom_film_mat:
-            for i in (0, 1, 2, 3):
-                for j in (0, 1, 2, 3):
-                    dg.add_stdfloat(self.custom_film_mat[j][i])
+            dg.add_mat4(self.custom_film_mat)
 
 
 class PerspectiveLens(Lens):
@@ -167,16 +163,10 @@ class MatrixLens(Lens):
 
         dg.add_uint8(flags)
 
-        for i in (0, 1, 2, 3):
-            for j in (0, 1, 2, 3):
-                dg.add_stdfloat(self.user_mat[j][i])
+        dg.add_mat4(self.user_mat)
 
         if self.left_eye_mat:
-            for i in (0, 1, 2, 3):
-                for j in (0, 1, 2, 3):
-                    dg.add_stdfloat(self.left_eye_mat[j][i])
+            dg.add_mat4(self.left_eye_mat)
 
         if self.right_eye_mat:
-            for i in (0, 1, 2, 3):
-                for j in (0, 1, 2, 3):
-                    dg.add_stdfloat(self.right_eye_mat[j][i])
+            dg.add_mat4(self.right_eye_mat)
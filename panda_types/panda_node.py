@@ -118,10 +118,7 @@ class LODNode(PandaNode):
 
         dg.add_vec3(self.center)
         dg.add_uint16(len(self.switches))
-
-        for in_dist, out_dist in self.switches:
-            dg.add_stdfloat(in_dist)
-            dg.add_stdfloat(out_dist)
+        dg.add_vec2_array(self.switches)
 
 
 class LensNode(PandaNode):
@@ -299,6 +299,7 @@ class LightAttrib(RenderAttrib):
     __slots__ = 'off_all_lights', 'off_lights', 'on_lights'
 
     def __init__(self):
+        super().__init__()
         self.off_all_lights = False
         self.off_lights = set()
         self.on_lights = set()
@@ -57,9 +57,7 @@ class TransformState(NodeCachedReferenceCount):
         elif self.mat:
             dg.add_uint32(0x00000040)
 
-            for i in (0, 1, 2, 3):
-                for j in (0, 1, 2, 3):
-                    dg.add_stdfloat(self.mat[j][i])
+            dg.add_mat4(self.mat)
 
         else:
             # Identity transform.
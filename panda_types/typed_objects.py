@@ -5,10 +5,34 @@ class TypedObject(object):
 
 class TypedWritable(TypedObject):
 
-    __slots__ = 'modified',
+    # Weak references are used by BamWriter.release_objects().
+    __slots__ = '_modified', 'generation', '__weakref__'
 
     def __init__(self):
-        self.modified = False
+        self._modified = False
+        self.generation = 0
+
+    @property
+    def modified(self):
+        """ Should be set to True after changing an object that has been
+        written before, so that it is written again.  Doing so increments
+        the generation of the object; each BamWriter remembers which
+        generation it wrote last, so that all of them write the change,
+        even though the first one to do so resets this flag. """
+
+        return self._modified
+
+    @modified.setter
+    def modified(self, modified):
+        # Once set, the flag stays set until a writer writes the object, so
+        # any further changes before then are part of the same generation.
+        if modified and not getattr(self, '_modified', False):
+            try:
+                self.generation += 1
+            except AttributeError:
+                # TypedWritable.__init__ hasn't been called (yet).
+                self.generation = 1
+        self._modified = modified
 
     def write_datagram(self, manager, dg):
         pass
@@ -28,3 +52,239 @@ class CopyOnWriteObject(CachedTypedWritableReferenceCount):
 
 class NodeCachedReferenceCount(CachedTypedWritableReferenceCount):
     __slots__ = ()
+
+
+class TrackedList(list):
+    """ A list that marks the object owning it as modified whenever it is
+    changed.  Used for list attributes when change tracking is enabled. """
+
+    __slots__ = 'owner',
+
+    def __init__(self, owner, items=()):
+        super().__init__(items)
+        self.owner = owner
+
+    def __changed(self):
+        self.owner.modified = True
+
+    def __setitem__(self, index, value):
+        super().__setitem__(index, value)
+        self.__changed()
+
+    def __delitem__(self, index):
+        super().__delitem__(index)
+        self.__changed()
+
+    def __iadd__(self, items):
+        result = super().__iadd__(items)
+        self.__changed()
+        return result
+
+    def __imul__(self, count):
+        result = super().__imul__(count)
+        self.__changed()
+        return result
+
+    def append(self, item):
+        super().append(item)
+        self.__changed()
+
+    def extend(self, items):
+        super().extend(items)
+        self.__changed()
+
+    def insert(self, index, item):
+        super().insert(index, item)
+        self.__changed()
+
+    def remove(self, item):
+        super().remove(item)
+        self.__changed()
+
+    def pop(self, index=-1):
+        item = super().pop(index)
+        self.__changed()
+        return item
+
+    def clear(self):
+        super().clear()
+        self.__changed()
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self.__changed()
+
+    def reverse(self):
+        super().reverse()
+        self.__changed()
+
+
+class TrackedDict(dict):
+    """ A dict that marks the object owning it as modified whenever it is
+    changed.  Used for dict attributes when change tracking is enabled. """
+
+    __slots__ = 'owner',
+
+    def __init__(self, owner, items=()):
+        super().__init__(items)
+        self.owner = owner
+
+    def __changed(self):
+        self.owner.modified = True
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.__changed()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.__changed()
+
+    def __ior__(self, items):
+        result = super().__ior__(items)
+        self.__changed()
+        return result
+
+    def pop(self, *args):
+        item = super().pop(*args)
+        self.__changed()
+        return item
+
+    def popitem(self):
+        item = super().popitem()
+        self.__changed()
+        return item
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self.__changed()
+        return super().setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self.__changed()
+
+    def clear(self):
+        super().clear()
+        self.__changed()
+
+
+class TrackedSet(set):
+    """ A set that marks the object owning it as modified whenever it is
+    changed.  Used for set attributes when change tracking is enabled. """
+
+    __slots__ = 'owner',
+
+    def __init__(self, owner, items=()):
+        super().__init__(items)
+        self.owner = owner
+
+    def __changed(self):
+        self.owner.modified = True
+
+    def __ior__(self, items):
+        result = super().__ior__(items)
+        self.__changed()
+        return result
+
+    def __iand__(self, items):
+        result = super().__iand__(items)
+        self.__changed()
+        return result
+
+    def __isub__(self, items):
+        result = super().__isub__(items)
+        self.__changed()
+        return result
+
+    def __ixor__(self, items):
+        result = super().__ixor__(items)
+        self.__changed()
+        return result
+
+    def add(self, item):
+        if item not in self:
+            super().add(item)
+            self.__changed()
+
+    def discard(self, item):
+        if item in self:
+            super().discard(item)
+            self.__changed()
+
+    def remove(self, item):
+        super().remove(item)
+        self.__changed()
+
+    def pop(self):
+        item = super().pop()
+        self.__changed()
+        return item
+
+    def update(self, *args):
+        super().update(*args)
+        self.__changed()
+
+    def intersection_update(self, *args):
+        super().intersection_update(*args)
+        self.__changed()
+
+    def difference_update(self, *args):
+        super().difference_update(*args)
+        self.__changed()
+
+    def symmetric_difference_update(self, items):
+        super().symmetric_difference_update(items)
+        self.__changed()
+
+    def clear(self):
+        super().clear()
+        self.__changed()
+
+
+# Attributes that keep track of changes, rather than being changes.
+_tracking_names = frozenset(('modified', '_modified', 'generation'))
+
+
+def _tracking_setattr(self, name, value, setattr=object.__setattr__):
+    """ Replaces TypedWritable.__setattr__ while change tracking is enabled. """
+
+    if name not in _tracking_names:
+        cls = type(value)
+        if cls is list or (cls is TrackedList and value.owner is not self):
+            value = TrackedList(self, value)
+        elif cls is dict or (cls is TrackedDict and value.owner is not self):
+            value = TrackedDict(self, value)
+        elif cls is set or (cls is TrackedSet and value.owner is not self):
+            value = TrackedSet(self, value)
+
+        setattr(self, name, value)
+        if not getattr(self, '_modified', False):
+            setattr(self, 'modified', True)
+
+    else:
+        setattr(self, name, value)
+
+
+def enable_change_tracking():
+    """ Makes every TypedWritable set its own modified flag whenever one of
+    its attributes is assigned, or a list, dict or set held by one is
+    changed in place, so that BamWriter.write_changes() can find everything that needs
+    to be sent again.  Slows down all changes to these objects, so it is
+    off by default.
+
+    This works by replacing lists, dicts and sets by tracked copies as they
+    are assigned, so it should be enabled before the objects are created,
+    and they must not be shared between objects.  Changes made inside
+    other objects, such as the arrays held by a TypedWritable, are not
+    tracked; those still require setting the modified flag by hand. """
+
+    TypedWritable.__setattr__ = _tracking_setattr
+
+
+def disable_change_tracking():
+    """ Undoes enable_change_tracking.  Lists, dicts and sets that are
+    already tracked remain so. """
+
+    if '__setattr__' in TypedWritable.__dict__:
+        del TypedWritable.__setattr__
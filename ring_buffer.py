@@ -0,0 +1,356 @@
+""" A ring buffer in shared memory, for passing a bam stream to another
+process on the same machine without going through a socket.
+
+The writing side is a RingBufferTarget, which may be passed to
+BamWriter.open_target; the reading side is a RingBufferReader, which is
+opened in the other process using the name of the target's shared memory.
+
+The shared memory starts with a header of native-endian uint64 fields,
+laid out as follows, after which follow the contents of the ring:
+
+    offset 0:   write cursor, the total number of bytes written
+    offset 8:   set to 1 once the writer has closed the stream
+    offset 16:  capacity of the ring in bytes
+    offset 24:  process ID of the writer
+    offset 64:  read cursor, the total number of bytes consumed
+    offset 72:  set to 1 once the reader has gone away
+    offset 80:  process ID of the reader, or 0 until it has attached
+
+Each cursor is only ever changed by one side, and only after the data it
+covers has been copied, so no locking is needed.  The fields are accessed
+through a memoryview cast to uint64, so that each access is a single
+aligned load or store that can't be torn.  Whoever has to wait for the
+other side polls the cursors, with an increasing delay.
+
+A side that exits without closing its end, such as a viewer that crashes,
+can't set its closed flag.  While waiting, each side therefore also checks
+whether the other side's process still exists, where the platform allows
+this, and acts as if the other side had closed if it doesn't.  A timeout
+may be given as well, which also covers a reader that never attaches. """
+
+__all__ = ['RingBufferTarget', 'RingBufferReader']
+
+from multiprocessing import shared_memory
+import os
+import sys
+import time
+
+HEADER_SIZE = 128
+
+# Indices of the fields in the header, viewed as an array of uint64.
+_WRITE_POS = 0
+_WRITER_CLOSED = 1
+_CAPACITY = 2
+_WRITER_PID = 3
+_READ_POS = 8
+_READER_CLOSED = 9
+_READER_PID = 10
+
+# Longest time to sleep between polls while waiting for the other side.
+_MAX_POLL_DELAY = 0.001
+
+
+def _wait(condition, timeout=None):
+    """ Waits until condition() returns true, first yielding the processor
+    and then sleeping for increasingly long periods.  Raises TimeoutError
+    if this takes more than timeout seconds. """
+
+    delay = 0.0
+    deadline = None
+    while not condition():
+        if timeout is not None:
+            now = time.monotonic()
+            if deadline is None:
+                deadline = now + timeout
+            elif now >= deadline:
+                raise TimeoutError("timed out waiting for the other side of the ring buffer")
+
+        time.sleep(delay)
+        delay = min(delay * 2 or 0.00001, _MAX_POLL_DELAY)
+
+
+def _process_exists(pid):
+    """ Returns false if there is certainly no process with the given ID,
+    or true if there is one or this can't be determined. """
+
+    # On Windows, os.kill would terminate the process instead.
+    if os.name != 'posix' or pid == 0:
+        return True
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+
+    # A process that has exited but not been reaped by its parent yet, as
+    # happens when the viewer is a child of the writer, still exists as a
+    # zombie; Linux reports its state as Z.
+    try:
+        with open('/proc/%d/stat' % (pid), 'rb') as file:
+            stat = file.read()
+        return stat[stat.rindex(b')') + 2:][:1] != b'Z'
+    except (OSError, ValueError):
+        return True
+
+
+class RingBufferTarget(object):
+    """ File-like object that writes into a new shared memory ring buffer of
+    the given capacity.  The name of the shared memory, to be passed to the
+    reader, is available as the name attribute.
+
+    When the ring is full, write() waits for the reader to catch up.  If the
+    reader has gone away, it raises BrokenPipeError instead.  close() waits
+    until the reader has consumed everything, then removes the shared
+    memory.  If timeout is given, write() and close() raise TimeoutError
+    after waiting that many seconds at a time for the reader; close()
+    still removes the shared memory in that case. """
+
+    def __init__(self, name=None, capacity=1 << 22, timeout=None):
+        self.__shm = shared_memory.SharedMemory(name, create=True,
+                                                size=HEADER_SIZE + capacity)
+        self.name = self.__shm.name
+        self.capacity = capacity
+        self.timeout = timeout
+
+        self.__header = self.__shm.buf[:HEADER_SIZE].cast('Q')
+        self.__ring = self.__shm.buf[HEADER_SIZE:HEADER_SIZE + capacity]
+        self.__write_pos = 0
+
+        self.__header[_CAPACITY] = capacity
+        self.__header[_WRITER_PID] = os.getpid()
+
+    def write(self, data):
+        header = self.__header
+        ring = self.__ring
+        capacity = self.capacity
+        pos = self.__write_pos
+
+        with memoryview(data) as view:
+            view = view.cast('B')
+            size = view.nbytes
+
+            while view:
+                free = capacity - (pos - header[_READ_POS])
+                if free == 0:
+                    self.__wait_for_reader(pos - capacity + 1)
+                    continue
+
+                count = min(free, len(view))
+                start = pos % capacity
+                first = min(count, capacity - start)
+                ring[start:start + first] = view[:first]
+                if count > first:
+                    ring[:count - first] = view[first:count]
+
+                # Only now make the data visible to the reader.
+                pos += count
+                header[_WRITE_POS] = pos
+                self.__write_pos = pos
+                view = view[count:]
+
+        return size
+
+    def flush(self):
+        # Anything written is immediately visible to the reader.
+        pass
+
+    def close(self):
+        if self.__shm is None:
+            return
+
+        self.__header[_WRITER_CLOSED] = 1
+
+        try:
+            self.__wait_for_reader(self.__write_pos)
+        except BrokenPipeError:
+            pass
+        finally:
+            # Also after a timeout, which is raised once this is done.
+            self.__header.release()
+            self.__ring.release()
+            self.__shm.close()
+            self.__shm.unlink()
+            self.__shm = None
+
+    def __wait_for_reader(self, min_read_pos):
+        """ Waits until the reader has consumed at least up to the given
+        position in the stream. """
+
+        header = self.__header
+
+        def caught_up():
+            if header[_READER_CLOSED]:
+                raise BrokenPipeError("reader has closed the ring buffer")
+            if header[_READ_POS] >= min_read_pos:
+                return True
+            if not _process_exists(header[_READER_PID]):
+                raise BrokenPipeError("reader process has exited")
+            return False
+
+        _wait(caught_up, self.timeout)
+
+
+class RingBufferReader(object):
+    """ Reads the stream written by a RingBufferTarget in another process,
+    given the name of its shared memory.  If the writer's process exits
+    without closing the stream, reading raises EOFError once everything it
+    wrote has been read.  If timeout is given, reading raises TimeoutError
+    after waiting that many seconds for data. """
+
+    def __init__(self, name, timeout=None):
+        # The writer owns the shared memory; don't let the resource tracker
+        # of this process remove it when this process exits.
+        if sys.version_info >= (3, 13):
+            self.__shm = shared_memory.SharedMemory(name, track=False)
+        else:
+            self.__shm = shared_memory.SharedMemory(name)
+            try:
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(self.__shm._name, 'shared_memory')
+            except (ImportError, AttributeError):
+                pass
+
+        self.__header = self.__shm.buf[:HEADER_SIZE].cast('Q')
+        self.capacity = self.__header[_CAPACITY]
+        self.__ring = self.__shm.buf[HEADER_SIZE:HEADER_SIZE + self.capacity]
+        self.__read_pos = 0
+        self.__writer_gone = False
+        self.timeout = timeout
+
+        self.__header[_READER_PID] = os.getpid()
+
+    def read(self, size=-1):
+        """ Returns up to size bytes, or everything available if size is
+        negative, waiting until at least one byte is available.  Returns an
+        empty bytes object once the writer has closed the stream and
+        everything has been read. """
+
+        available = self.__wait_for_data()
+        if size < 0 or size > available:
+            size = available
+
+        start = self.__read_pos % self.capacity
+        if start + size <= self.capacity:
+            data = self.__ring[start:start + size].tobytes()
+            self.__advance(size)
+            return data
+
+        data = bytearray(size)
+        self.__consume(memoryview(data))
+        return bytes(data)
+
+    def readinto(self, buffer):
+        """ Reads into the given writable buffer, as read() does, and returns
+        the number of bytes read. """
+
+        with memoryview(buffer) as view:
+            view = view.cast('B')
+            available = self.__wait_for_data()
+            return self.__consume(view[:available])
+
+    def read_exactly(self, size):
+        """ Returns a bytearray of exactly size bytes, or raises EOFError if
+        the stream ends before then. """
+
+        data = bytearray(size)
+        self.__fill(memoryview(data))
+        return data
+
+    def read_datagrams(self):
+        """ Yields the contents of each length-prefixed datagram in the
+        stream as a bytearray, starting with the bam header, until the
+        writer closes. """
+
+        # Small datagrams are taken from whatever is available at once, but
+        # large ones are read straight into their own buffer.
+        pending = bytearray()
+        while True:
+            while len(pending) < 4:
+                data = self.read()
+                if not data:
+                    if pending:
+                        raise EOFError("ring buffer closed in the middle of a datagram")
+                    return
+                pending += data
+
+            end = 4 + int.from_bytes(pending[:4], 'little')
+            if end <= len(pending):
+                datagram = pending[4:end]
+                del pending[:end]
+            else:
+                datagram = bytearray(end - 4)
+                datagram[:len(pending) - 4] = pending[4:]
+                self.__fill(memoryview(datagram)[len(pending) - 4:])
+                pending.clear()
+
+            yield datagram
+
+    def close(self):
+        """ Detaches from the shared memory, letting the writer know that
+        nothing more will be read. """
+
+        if self.__shm is None:
+            return
+
+        self.__header[_READER_CLOSED] = 1
+        self.__header.release()
+        self.__ring.release()
+        self.__shm.close()
+        self.__shm = None
+
+    def __available(self):
+        return self.__header[_WRITE_POS] - self.__read_pos
+
+    def __wait_for_data(self):
+        """ Waits until there is data to read or the writer has closed, and
+        returns the number of bytes available. """
+
+        header = self.__header
+
+        def ready():
+            # Check the flag first, so that no data written just before it
+            # was set can be missed.
+            if header[_WRITER_CLOSED]:
+                return True
+            if self.__available():
+                return True
+            if not _process_exists(header[_WRITER_PID]):
+                # Whatever it wrote is still there; read that first.
+                self.__writer_gone = True
+                return True
+            return False
+
+        _wait(ready, self.timeout)
+        available = self.__available()
+        if available == 0 and self.__writer_gone:
+            raise EOFError("writer process exited without closing the ring buffer")
+        return available
+
+    def __fill(self, view):
+        """ Fills the given view entirely. """
+
+        while view:
+            if self.__wait_for_data() == 0:
+                raise EOFError("ring buffer closed in the middle of a read")
+            view = view[self.__consume(view[:self.__available()]):]
+
+    def __advance(self, count):
+        self.__read_pos += count
+        self.__header[_READ_POS] = self.__read_pos
+
+    def __consume(self, view):
+        """ Copies the next view.nbytes bytes out of the ring and advances
+        the read cursor past them. """
+
+        count = view.nbytes
+        capacity = self.capacity
+        start = self.__read_pos % capacity
+        first = min(count, capacity - start)
+        view[:first] = self.__ring[start:start + first]
+        if count > first:
+            view[first:count] = self.__ring[:count - first]
+
+        self.__advance(count)
+        return count
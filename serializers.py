@@ -0,0 +1,450 @@
+""" Compiles the write_datagram methods of a class into a single flat function
+for a particular file version and stdfloat mode, for use by a BamWriter
+created with compile_serializers=True.
+
+The source of each write_datagram method in the class hierarchy is parsed,
+and the following transformations are applied:
+
+  - comparisons of manager.file_version against constant tuples are folded,
+    and the branches that can never be taken are dropped;
+  - the super().write_datagram(manager, dg) calls are replaced by the body
+    of the overridden method, or by a call to its compiled version if that
+    can't be done safely;
+  - calls to the fixed-size add_* methods of the datagram are turned into
+    packing with precompiled Structs, and consecutive ones are merged into a
+    single Struct where that doesn't change the order of evaluation.
+
+The result writes exactly the same bytes as calling write_datagram.  If a
+method can't be compiled, for instance because its source is not available,
+compile_serializer returns the method itself. """
+
+__all__ = ['compile_serializer']
+
+from struct import Struct
+import builtins
+import inspect
+import linecache
+import textwrap
+import ast
+
+# Struct format characters of the add_* methods that write a fixed number
+# of values; the stdfloat methods are filled in based on the stdfloat mode.
+_FIXED_FORMATS = {
+    'add_bool': '?',
+    'add_int8': 'b',
+    'add_int16': 'h',
+    'add_int32': 'i',
+    'add_int64': 'q',
+    'add_uint8': 'B',
+    'add_uint16': 'H',
+    'add_uint32': 'I',
+    'add_uint64': 'Q',
+    'add_float32': 'f',
+    'add_float64': 'd',
+}
+
+# Number of stdfloats written by each of the stdfloat methods.  Their
+# arguments are unpacked into the Struct's arguments.
+_STDFLOAT_COUNTS = {
+    'add_stdfloat': 1,
+    'add_vec2': 2,
+    'add_vec3': 3,
+    'add_vec4': 4,
+}
+
+# Functions that may appear in an argument that is merged with others, since
+# they can't have any effect on the datagram.
+_PURE_FUNCTIONS = frozenset(('len', 'int', 'float', 'bool', 'min', 'max', 'abs'))
+
+# Cache of compiled serializers, keyed by class, file version and stdfloat
+# mode.  Each entry also holds the write_datagram it was compiled from, so
+# that it can be recompiled if that is replaced.
+_cache = {}
+
+
+class CompileError(Exception):
+    pass
+
+
+def compile_serializer(cls, file_version, stdfloat_double):
+    """ Returns a function taking (object, manager, dg) arguments that writes
+    an object of the given class in the same way as its write_datagram. """
+
+    method = cls.write_datagram
+    key = (cls, file_version, stdfloat_double)
+    entry = _cache.get(key)
+    if entry is not None and entry[0] is method:
+        return entry[1]
+
+    chain = [klass for klass in cls.__mro__ if 'write_datagram' in klass.__dict__]
+    try:
+        serializer = _Compiler(chain, file_version, stdfloat_double).compile(cls)
+    except CompileError:
+        serializer = method
+
+    _cache[key] = (method, serializer)
+    return serializer
+
+
+class _Compiler(object):
+
+    def __init__(self, chain, file_version, stdfloat_double):
+        self.chain = chain
+        self.file_version = file_version
+        self.stdfloat_double = stdfloat_double
+        self.stdfloat_char = 'd' if stdfloat_double else 'f'
+
+    def compile(self, cls):
+        namespace = {}
+        body = self.__compile_body(0, namespace)
+        return self.__build_function('write_' + cls.__name__, body, namespace)
+
+    def __compile_body(self, index, namespace):
+        """ Returns the statements making up the write_datagram of the given
+        class in the chain, with any super() call resolved.  Adds the global
+        names it needs to namespace. """
+
+        klass = self.chain[index]
+        function = klass.__dict__['write_datagram']
+        if not inspect.isfunction(function):
+            raise CompileError
+
+        try:
+            source = textwrap.dedent(inspect.getsource(function))
+        except (OSError, TypeError):
+            raise CompileError
+
+        node = ast.parse(source).body[0]
+        if not isinstance(node, ast.FunctionDef) or node.decorator_list:
+            raise CompileError
+
+        args = node.args
+        if args.vararg or args.kwarg or args.kwonlyargs or args.posonlyargs or \
+           [arg.arg for arg in args.args] != ['self', 'manager', 'dg']:
+            raise CompileError
+
+        body = _Mangler(klass.__name__).visit_body(node.body)
+        body = _Folder(self.file_version, self.stdfloat_double).fold_body(body)
+
+        self.__add_globals(namespace, function, body)
+
+        # The super() call must be a statement of its own.
+        for i, stmt in enumerate(body):
+            if _is_super_call(stmt):
+                body[i:i + 1] = self.__compile_super(index, body, namespace)
+                break
+
+        if 'super' in _loaded_names(body):
+            raise CompileError
+
+        return body
+
+    def __compile_super(self, index, body, namespace):
+        """ Returns the statements to replace super().write_datagram with. """
+
+        if index + 1 >= len(self.chain):
+            raise CompileError
+
+        parent_namespace = {}
+        parent_body = self.__compile_body(index + 1, parent_namespace)
+
+        inline_body = parent_body
+        if inline_body and isinstance(inline_body[-1], ast.Return) and inline_body[-1].value is None:
+            inline_body = inline_body[:-1]
+
+        # Only inline if the parent does not return early, its locals can't
+        # shadow names that the child expects to be global, and its globals
+        # mean the same thing in the child's module.
+        parent_locals = _local_names(inline_body)
+        inline = not _contains_return(inline_body) and \
+            not (parent_locals & (_loaded_names(body) - _local_names(body)))
+
+        for name, value in parent_namespace.items():
+            if name in namespace and namespace[name] is not value:
+                inline = False
+
+        if inline:
+            namespace.update(parent_namespace)
+            return inline_body
+
+        name = '_write_' + self.chain[index + 1].__name__
+        namespace[name] = self.__build_function(name, parent_body, parent_namespace)
+        return ast.parse("%s(self, manager, dg)" % name).body
+
+    def __build_function(self, name, body, namespace):
+        """ Turns the given statements into a function with the usual
+        (self, manager, dg) arguments. """
+
+        if '_data' in _local_names(body) or '_data' in _loaded_names(body):
+            raise CompileError
+
+        # Bind the buffer of the datagram to a local for the packed writes.
+        body = self.__pack_adds(body, namespace)
+        module = ast.parse("def %s(self, manager, dg):\n    _data = dg.data\n" % name)
+        module.body[0].body += body or [ast.Pass()]
+
+        # Register the generated source, so that tracebacks can show it.
+        source = ast.unparse(ast.fix_missing_locations(module)) + '\n'
+        filename = '<serializer %s %s%s>' % (name, '.'.join(map(str, self.file_version)),
+                                            ' double' if self.stdfloat_double else '')
+        linecache.cache[filename] = (len(source), None, source.splitlines(True), filename)
+
+        namespace.setdefault('__builtins__', builtins)
+        exec(compile(source, filename, 'exec'), namespace)
+        return namespace[name]
+
+    def __add_globals(self, namespace, function, body):
+        """ Adds the globals that the given body of the function may refer to
+        to the namespace. """
+
+        module_globals = function.__globals__
+        for name in _loaded_names(body) - _local_names(body):
+            if name in module_globals:
+                namespace[name] = module_globals[name]
+
+    def __pack_adds(self, body, namespace):
+        """ Replaces the fixed-size add_* calls in the given statements. """
+
+        result = []
+        group = []
+
+        for stmt in body:
+            add = self.__fixed_add(stmt)
+            if add is not None:
+                # Merging delays the write of the previous values until the
+                # arguments have been evaluated, which must not matter.
+                if group and not all(_is_pure(arg) for arg in add[1]):
+                    result.append(self.__packed_statement(group, namespace))
+                    group = []
+                group.append(add)
+                continue
+
+            if group:
+                result.append(self.__packed_statement(group, namespace))
+                group = []
+
+            # Recurse into compound statements, but not into nested
+            # functions, which can't assign to our _data.
+            if isinstance(stmt, (ast.If, ast.For, ast.While, ast.With)):
+                stmt.body = self.__pack_adds(stmt.body, namespace)
+                if getattr(stmt, 'orelse', None):
+                    stmt.orelse = self.__pack_adds(stmt.orelse, namespace)
+
+            result.append(stmt)
+
+        if group:
+            result.append(self.__packed_statement(group, namespace))
+
+        return result
+
+    def __fixed_add(self, stmt):
+        """ If the statement is a dg.add_* call of fixed size, returns a
+        (format, args) tuple. """
+
+        if not isinstance(stmt, ast.Expr) or not isinstance(stmt.value, ast.Call):
+            return None
+
+        call = stmt.value
+        func = call.func
+        if not isinstance(func, ast.Attribute) or not isinstance(func.value, ast.Name) or \
+           func.value.id != 'dg' or call.keywords or len(call.args) != 1 or \
+           isinstance(call.args[0], ast.Starred):
+            return None
+
+        if func.attr in _FIXED_FORMATS:
+            return _FIXED_FORMATS[func.attr], [call.args[0]]
+
+        count = _STDFLOAT_COUNTS.get(func.attr)
+        if count == 1:
+            return self.stdfloat_char, [call.args[0]]
+        elif count is not None:
+            return self.stdfloat_char * count, [ast.Starred(value=call.args[0], ctx=ast.Load())]
+
+        return None
+
+    def __packed_statement(self, group, namespace):
+        """ Returns a statement packing the values of the given adds. """
+
+        fmt = ''.join(add[0] for add in group)
+        name = '_pack_' + fmt.replace('?', 'x')
+        namespace[name] = Struct('<' + fmt).pack
+
+        args = [arg for add in group for arg in add[1]]
+        call = ast.Call(func=ast.Name(name, ast.Load()), args=args, keywords=[])
+        return ast.AugAssign(target=ast.Name('_data', ast.Store()), op=ast.Add(), value=call)
+
+
+class _Mangler(ast.NodeTransformer):
+    """ Applies the name mangling that compiling the method inside its class
+    would have applied to private names. """
+
+    def __init__(self, class_name):
+        self.prefix = '_' + class_name.lstrip('_')
+
+    def visit_body(self, body):
+        return [self.visit(stmt) for stmt in body]
+
+    def mangle(self, name):
+        if name.startswith('__') and not name.endswith('__'):
+            return self.prefix + name
+        return name
+
+    def visit_Attribute(self, node):
+        self.generic_visit(node)
+        node.attr = self.mangle(node.attr)
+        return node
+
+    def visit_Name(self, node):
+        node.id = self.mangle(node.id)
+        return node
+
+
+class _Folder(ast.NodeTransformer):
+    """ Resolves checks of manager.file_version and
+    manager.file_stdfloat_double, and drops unreachable code. """
+
+    def __init__(self, file_version, stdfloat_double):
+        self.constants = {
+            'file_version': file_version,
+            'file_stdfloat_double': stdfloat_double,
+        }
+
+    def fold_body(self, body):
+        result = []
+        for stmt in body:
+            stmt = self.visit(stmt)
+            if isinstance(stmt, list):
+                result += stmt
+            elif stmt is not None and not isinstance(stmt, ast.Pass):
+                result.append(stmt)
+
+            # Anything after a return is unreachable.
+            if result and isinstance(result[-1], ast.Return):
+                break
+
+        return result
+
+    def generic_visit(self, node):
+        for field, value in ast.iter_fields(node):
+            if isinstance(value, list):
+                if value and isinstance(value[0], ast.stmt):
+                    value = self.fold_body(value)
+                    if not value and field == 'body':
+                        value = [ast.Pass()]
+                else:
+                    value = [self.visit(item) if isinstance(item, ast.AST) else item
+                             for item in value]
+                setattr(node, field, value)
+            elif isinstance(value, ast.AST):
+                setattr(node, field, self.visit(value))
+        return node
+
+    def visit_Attribute(self, node):
+        if isinstance(node.value, ast.Name) and node.value.id == 'manager' and \
+           node.attr in self.constants and isinstance(node.ctx, ast.Load):
+            return ast.copy_location(ast.Constant(self.constants[node.attr]), node)
+        return self.generic_visit(node)
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        operands = [node.left] + node.comparators
+        if all(isinstance(operand, ast.Constant) or _is_constant_tuple(operand)
+               for operand in operands):
+            try:
+                value = eval(compile(ast.Expression(node), '<fold>', 'eval'), {})
+            except Exception:
+                return node
+            return ast.copy_location(ast.Constant(value), node)
+        return node
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Not) and isinstance(node.operand, ast.Constant):
+            return ast.copy_location(ast.Constant(not node.operand.value), node)
+        return node
+
+    def visit_If(self, node):
+        node.test = self.visit(node.test)
+        if isinstance(node.test, ast.Constant):
+            return self.fold_body(node.body if node.test.value else node.orelse) or None
+        return self.generic_visit(node)
+
+    def visit_IfExp(self, node):
+        node.test = self.visit(node.test)
+        if isinstance(node.test, ast.Constant):
+            return self.visit(node.body if node.test.value else node.orelse)
+        return self.generic_visit(node)
+
+    def visit_FunctionDef(self, node):
+        # Nested functions have a scope of their own.
+        return node
+
+
+def _is_constant_tuple(node):
+    return isinstance(node, ast.Tuple) and all(isinstance(elt, ast.Constant) for elt in node.elts)
+
+
+def _is_super_call(stmt):
+    """ Returns True if the statement is super().write_datagram(manager, dg). """
+
+    if not isinstance(stmt, ast.Expr) or not isinstance(stmt.value, ast.Call):
+        return False
+
+    call = stmt.value
+    func = call.func
+    return isinstance(func, ast.Attribute) and func.attr == 'write_datagram' and \
+        isinstance(func.value, ast.Call) and isinstance(func.value.func, ast.Name) and \
+        func.value.func.id == 'super' and not func.value.args and \
+        [getattr(arg, 'id', None) for arg in call.args] == ['manager', 'dg'] and \
+        not call.keywords
+
+
+def _walk_scope(body):
+    """ Yields the nodes in the given statements, without descending into
+    nested functions, other than their names and default values. """
+
+    stack = list(reversed(body))
+    while stack:
+        node = stack.pop()
+        yield node
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda)):
+            stack.extend(node.args.defaults)
+            continue
+        stack.extend(reversed(list(ast.iter_child_nodes(node))))
+
+
+def _contains_return(body):
+    return any(isinstance(node, ast.Return) for node in _walk_scope(body))
+
+
+def _local_names(body):
+    names = set()
+    for node in _walk_scope(body):
+        if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load):
+            names.add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, ast.alias):
+            names.add((node.asname or node.name).split('.')[0])
+    return names
+
+
+def _loaded_names(body):
+    """ Returns the names loaded in the given statements, including those in
+    nested functions, which may be global. """
+
+    return {node.id for stmt in body for node in ast.walk(stmt)
+            if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load)}
+
+
+def _is_pure(node):
+    """ Returns True if evaluating the expression can't add anything to the
+    datagram. """
+
+    for child in ast.walk(node):
+        if isinstance(child, ast.Call):
+            if not isinstance(child.func, ast.Name) or child.func.id not in _PURE_FUNCTIONS:
+                return False
+        elif isinstance(child, (ast.NamedExpr, ast.Await, ast.Yield, ast.YieldFrom, ast.Lambda)):
+            return False
+    return True
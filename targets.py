@@ -0,0 +1,406 @@
+""" File-like objects that may be used as the target of a BamWriter. """
+
+__all__ = ['ThreadedTarget', 'CompressedTarget', 'MappedFileTarget',
+           'BroadcastTarget', 'SocketTarget']
+
+from collections import deque
+import mmap
+import threading
+import queue
+import time
+import zlib
+
+# Special requests passed to the I/O thread of a ThreadedTarget.
+_FLUSH = object()
+_CLOSE = object()
+
+
+class SocketTarget(object):
+    """ Writes straight to a connected socket, without any buffering of its
+    own, so that the BamWriter's arena alone determines how the stream is
+    divided into sends. """
+
+    def __init__(self, sock):
+        self.socket = sock
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def write(self, data):
+        with memoryview(data) as view:
+            self.socket.sendall(view)
+            return view.nbytes
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.socket.close()
+
+
+class ThreadedTarget(object):
+    """ Wraps another file-like object so that all writes to it are done by a
+    dedicated I/O thread.  Buffers passed to write() are handed over to that
+    thread without copying them, so the caller must not modify them
+    afterwards; BamWriter never does.
+
+    At most max_pending writes may be waiting for the I/O thread at a time,
+    after which write() blocks until the thread catches up.  Any exception
+    raised by the wrapped object is re-raised by the next call to write(),
+    flush() or close(). """
+
+    def __init__(self, target, max_pending=8):
+        self.target = target
+        self.__queue = queue.Queue(max_pending)
+        self.__error = None
+        self.__error_raised = False
+        self.__thread = threading.Thread(target=self.__run, daemon=True,
+                                         name='ThreadedTarget')
+        self.__thread.start()
+
+    def write(self, data):
+        self.__check_error()
+        self.__queue.put(data)
+        return len(data)
+
+    def flush(self):
+        """ Waits until everything written so far has been passed on to the
+        wrapped object, and flushes it. """
+
+        self.__queue.put(_FLUSH)
+        self.__queue.join()
+        self.__check_error()
+
+    def close(self):
+        """ Writes out everything that is still pending, then closes the
+        wrapped object and stops the I/O thread. """
+
+        if self.__thread.is_alive():
+            self.__queue.put(_CLOSE)
+            self.__thread.join()
+
+        if not self.__error_raised:
+            self.__check_error()
+
+    def __check_error(self):
+        error = self.__error
+        if error is not None:
+            self.__error_raised = True
+            raise error
+
+    def __run(self):
+        target = self.target
+        failed = False
+
+        while True:
+            item = self.__queue.get()
+            try:
+                if item is _CLOSE:
+                    # Even after an error, make sure the target is closed,
+                    # but don't let that mask the original error.
+                    try:
+                        target.close()
+                    except BaseException:
+                        if not failed:
+                            raise
+                    return
+
+                # After an error, keep draining the queue so that nobody
+                # blocks on it, but stop writing to the target.
+                if failed:
+                    continue
+
+                if item is _FLUSH:
+                    target.flush()
+                else:
+                    target.write(item)
+
+            except BaseException as ex:
+                self.__error = ex
+                failed = True
+
+            finally:
+                self.__queue.task_done()
+
+
+class CompressedTarget(object):
+    """ Wraps another file-like object, compressing everything written to it
+    into a zlib stream, as used by Panda for .pz files.  Keeps statistics on
+    how well and how fast the data compresses.
+
+    zlib releases the GIL while compressing, so wrapping this in a
+    ThreadedTarget lets compression run in parallel with encoding.
+
+    flush() does not flush the compressor, since that would make the output
+    larger; the end of the stream is only written by close(). """
+
+    def __init__(self, target, level=zlib.Z_DEFAULT_COMPRESSION):
+        self.target = target
+        self.level = level
+        self.__compressor = zlib.compressobj(level)
+
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.compress_time = 0.0
+
+    @property
+    def ratio(self):
+        """ The size of the compressed output relative to the input. """
+        return self.bytes_out / self.bytes_in if self.bytes_in else 1.0
+
+    @property
+    def throughput(self):
+        """ The number of input bytes compressed per second. """
+        return self.bytes_in / self.compress_time if self.compress_time else 0.0
+
+    def write(self, data):
+        start = time.perf_counter()
+        compressed = self.__compressor.compress(data)
+        self.compress_time += time.perf_counter() - start
+
+        with memoryview(data) as view:
+            size = view.nbytes
+        self.bytes_in += size
+        if compressed:
+            self.bytes_out += len(compressed)
+            self.target.write(compressed)
+        return size
+
+    def flush(self):
+        self.target.flush()
+
+    def close(self):
+        start = time.perf_counter()
+        compressed = self.__compressor.flush()
+        self.compress_time += time.perf_counter() - start
+
+        self.bytes_out += len(compressed)
+        self.target.write(compressed)
+        self.target.close()
+
+
+class MappedFileTarget(object):
+    """ Writes to a file through a shared memory mapping rather than through
+    write() calls, leaving it to the page cache to write the data back.
+
+    The file is created with size_hint bytes, or 1 MiB if no hint is given,
+    and doubled in size whenever it runs out of space.  close() truncates it
+    to the length that was actually written.  A good size_hint may be
+    obtained from BamWriter.measure_objects() and measure_header(). """
+
+    def __init__(self, fn, size_hint=None):
+        self.__file = open(fn, 'w+b')
+        self.__size = max(size_hint or (1 << 20), mmap.PAGESIZE)
+        self.__pos = 0
+
+        self.__file.truncate(self.__size)
+        self.__map = mmap.mmap(self.__file.fileno(), self.__size)
+
+    def tell(self):
+        return self.__pos
+
+    def write(self, data):
+        with memoryview(data) as view:
+            size = view.nbytes
+            pos = self.__pos
+            end = pos + size
+            if end > self.__size:
+                self.__grow(end)
+
+            self.__map[pos:end] = view.cast('B') if view.format != 'B' else view
+
+        self.__pos = end
+        return size
+
+    def flush(self):
+        # Writeback is left to the page cache.
+        pass
+
+    def close(self):
+        if self.__map is None:
+            return
+
+        self.__map.close()
+        self.__map = None
+        self.__file.truncate(self.__pos)
+        self.__file.close()
+
+    def __grow(self, min_size):
+        size = max(self.__size * 2, min_size)
+        self.__map.resize(size)
+        self.__size = size
+
+
+class BroadcastTarget(object):
+    """ Passes everything written to it on to any number of other file-like
+    objects, so that a stream that goes to many clients needs to be encoded
+    only once.  Each client is served by its own I/O thread, and the buffers
+    written are shared between all clients rather than copied.  Since the
+    clients write them out later, buffers other than bytes and bytearray
+    objects, such as views of vertex data passed on by a BamWriter with a
+    zero_copy_threshold, are copied once, so that their owners may modify
+    them as soon as write() returns.
+
+    Each client may fall behind by up to max_buffered bytes.  What happens
+    when a client falls further behind depends on the policy: with
+    'disconnect', the default, the client is dropped and closed, so that a
+    stalled client can't hold up the others; with 'block', write() waits
+    for that client to catch up, holding back the others.  Clients whose
+    target raises an error are dropped as well.
+    Dropped clients are removed from targets and listed in dropped, as
+    (target, exception) pairs.
+
+    Dropping individual datagrams is not an option, since the bam stream
+    is stateful: a client that missed one cannot make sense of the rest. """
+
+    def __init__(self, targets=(), max_buffered=1 << 24, policy='disconnect'):
+        assert policy in ('block', 'disconnect')
+
+        self.max_buffered = max_buffered
+        self.policy = policy
+        self.dropped = []
+        self.__clients = []
+
+        for target in targets:
+            self.add_target(target)
+
+    @property
+    def targets(self):
+        return [client.target for client in self.__clients]
+
+    def add_target(self, target):
+        """ Adds a client.  It only receives what is written from now on,
+        so unless this is done before the header is written, the target
+        should first be brought up to date by other means. """
+
+        client = _BroadcastClient(target, self.max_buffered, self.policy)
+        self.__clients.append(client)
+
+    def write(self, data):
+        if not isinstance(data, (bytes, bytearray)):
+            data = memoryview(data).tobytes()
+        size = len(data)
+
+        for client in self.__clients:
+            client.put(data, size)
+
+        self.__remove_dropped()
+        return size
+
+    def flush(self):
+        """ Asks each client's I/O thread to flush its target once it gets
+        to this point, without waiting for that to happen. """
+
+        for client in self.__clients:
+            client.put(_FLUSH, 0)
+
+        self.__remove_dropped()
+
+    def close(self):
+        """ Waits until each client has received everything, then closes
+        all targets. """
+
+        for client in self.__clients:
+            client.close()
+
+        self.__remove_dropped()
+        self.__clients = []
+
+    def __remove_dropped(self):
+        clients = self.__clients
+        if any(client.error is not None for client in clients):
+            for client in clients:
+                if client.error is not None:
+                    self.dropped.append((client.target, client.error))
+            self.__clients = [client for client in clients if client.error is None]
+
+
+class _BroadcastClient(object):
+    """ One of the targets of a BroadcastTarget, with its own I/O thread. """
+
+    def __init__(self, target, max_buffered, policy):
+        self.target = target
+        self.error = None
+
+        self.__max_buffered = max_buffered
+        self.__policy = policy
+        self.__items = deque()
+        self.__buffered = 0
+        self.__condition = threading.Condition()
+        self.__thread = threading.Thread(target=self.__run, daemon=True,
+                                         name='BroadcastTarget')
+        self.__thread.start()
+
+    def put(self, item, size):
+        with self.__condition:
+            if self.error is not None:
+                return
+
+            if self.__buffered > 0 and self.__buffered + size > self.__max_buffered:
+                if self.__policy == 'disconnect':
+                    self.__fail(BufferError("client fell more than %d bytes "
+                                            "behind" % self.__max_buffered))
+                    return
+
+                while self.__buffered > 0 and self.__buffered + size > self.__max_buffered:
+                    self.__condition.wait()
+
+                if self.error is not None:
+                    return
+
+            self.__items.append((item, size))
+            self.__buffered += size
+            self.__condition.notify_all()
+
+    def close(self):
+        # The I/O thread of a client that was dropped may be stuck writing to
+        # it, so don't wait for that one; it will close the target itself.
+        self.put(_CLOSE, 0)
+        if self.error is None:
+            self.__thread.join()
+
+    def __fail(self, error):
+        """ Drops everything still pending, and lets the I/O thread close the
+        target once it is done with the current write.  Must be called with
+        the lock held. """
+
+        self.error = error
+        self.__items.clear()
+        self.__items.append((_CLOSE, 0))
+        self.__buffered = 0
+        self.__condition.notify_all()
+
+    def __run(self):
+        target = self.target
+        condition = self.__condition
+
+        while True:
+            with condition:
+                while not self.__items:
+                    condition.wait()
+                item, size = self.__items.popleft()
+
+            if item is _CLOSE:
+                try:
+                    target.close()
+                except BaseException as ex:
+                    if self.error is None:
+                        self.error = ex
+                return
+
+            try:
+                if item is _FLUSH:
+                    target.flush()
+                else:
+                    target.write(item)
+
+            except BaseException as ex:
+                with condition:
+                    if self.error is None:
+                        self.__fail(ex)
+
+            else:
+                with condition:
+                    if self.error is None:
+                        self.__buffered -= size
+                        condition.notify_all()
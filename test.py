@@ -1,8 +1,9 @@
 from .panda_types import *
 from array import array
 
-if __name__ == '__main__':
-    from .bam_writer import BamWriter
+
+def build_scene():
+    """ Builds the scene that is written to test.bam. """
 
     model = ModelRoot("test")
 
@@ -76,9 +77,15 @@ if __name__ == '__main__':
     cnode.into_collide_mask = 0b10
     child1.add_child(cnode)
 
+    return model
+
+
+if __name__ == '__main__':
+    from .bam_writer import BamWriter
+
     writer = BamWriter()
     writer.open_file('test.bam')
-    writer.write_object(model)
+    writer.write_object(build_scene())
     writer.close()
 
     print("test.bam written")